@@ -0,0 +1,248 @@
+#!/bin/env python
+# ^_^ encoding: utf-8 ^_^
+# @date: 2026/10/19
+"""
+cache
+缓存后端, 可以作为 Memoize 的 cache 使用 (dict-like, 支持 get 和 __setitem__)
+
+    DiskCache: 基于 sqlite 的持久化缓存, 前面有一层内存热缓存, 重启后仍然有效
+    SharedMemoryCache: 基于共享内存 (mmap) 的缓存, pre-fork 的多个子进程共享同一份缓存
+"""
+
+__author__ = 'wujiabin'
+
+import cPickle
+import hashlib
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from simutils.utils import LimitedSizeDict
+
+
+class DiskCache(object):
+    """
+    A dict-like store persisting values in a local sqlite database, with a
+    bounded in-memory hot tier in front of it.
+
+    Entries are grouped by `name` and tagged with `version`; opening the cache
+    with a new version drops the entries written by the old one. At most
+    `max_entries` entries are kept per name, the least recently used ones are
+    evicted first. Keys and values must be picklable, others only live in the
+    hot tier.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'memoize.db')
+        >>> c = DiskCache(path, name='f', version='1')
+        >>> c['a'] = 1
+        >>> c.get('a'), c.get('b')
+        (1, None)
+        >>> DiskCache(path, name='f', version='1')['a']
+        1
+        >>> 'a' in DiskCache(path, name='f', version='2')
+        False
+    """
+
+    def __init__(self, path, name='', version='', max_entries=10000, hot_size=1000):
+        self.path = path
+        self.name = name
+        self.version = version
+        self.max_entries = max_entries
+        self.hot = LimitedSizeDict(size_limit=hot_size)
+        # LimitedSizeDict 不是线程安全的, Memoize 会在后台线程里写缓存
+        self._hot_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = None
+        self._pid = None
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute('CREATE TABLE IF NOT EXISTS memoize ('
+                         'name TEXT, version TEXT, key TEXT, value BLOB, atime REAL, '
+                         'PRIMARY KEY (name, key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS memoize_atime ON memoize (name, atime)')
+            conn.execute('DELETE FROM memoize WHERE name = ? AND version != ?', (name, version))
+
+    def _connect(self):
+        # sqlite 的连接不能跨 fork 使用, 子进程里重新连接
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _digest(self, key):
+        return hashlib.sha1(cPickle.dumps(key, 2)).hexdigest()
+
+    def get(self, key, default=None):
+        try:
+            with self._hot_lock:
+                return self.hot[key]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable key
+            return default
+
+        try:
+            digest = self._digest(key)
+        except (cPickle.PicklingError, TypeError):
+            return default
+
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT value FROM memoize WHERE name = ? AND key = ? AND version = ?',
+                               (self.name, digest, self.version)).fetchone()
+            if row is None:
+                return default
+            conn.execute('UPDATE memoize SET atime = ? WHERE name = ? AND key = ?',
+                         (time.time(), self.name, digest))
+
+        value = cPickle.loads(str(row[0]))
+        with self._hot_lock:
+            self.hot[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __setitem__(self, key, value):
+        with self._hot_lock:
+            self.hot[key] = value
+        try:
+            digest = self._digest(key)
+            data = sqlite3.Binary(cPickle.dumps(value, 2))
+        except (cPickle.PicklingError, TypeError):
+            return
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO memoize (name, version, key, value, atime) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (self.name, self.version, digest, data, time.time()))
+            # 每写入一定次数才检查一次大小, 避免每次都做 count
+            self._writes += 1
+            if self.max_entries and self._writes >= max(1, self.max_entries / 10):
+                self._writes = 0
+                conn.execute('DELETE FROM memoize WHERE name = ? AND key IN '
+                             '(SELECT key FROM memoize WHERE name = ? ORDER BY atime DESC LIMIT -1 OFFSET ?)',
+                             (self.name, self.name, self.max_entries))
+
+    def clear(self):
+        with self._hot_lock:
+            self.hot.clear()
+        with self._lock:
+            self._connect().execute('DELETE FROM memoize WHERE name = ?', (self.name,))
+
+
+class SharedMemoryCache(object):
+    """
+    A dict-like store kept in an anonymous shared mmap, so that the processes
+    forked after it is created share the same cached values. Create it in the
+    master process, before forking the workers.
+
+    The region is split into `slots` fixed-size slots of `slot_size` bytes,
+    indexed by the md5 of the pickled key with linear probing over `probes`
+    slots; when they are all taken the first one is overwritten. Every slot is
+    guarded by one of `stripes` process-shared locks. Values which don't fit
+    in a slot are not cached.
+
+        >>> c = SharedMemoryCache(slots=16, slot_size=128)
+        >>> def worker(): c['a'] = 1
+        >>> p = multiprocessing.Process(target=worker)
+        >>> p.start(); p.join()
+        >>> c.get('a'), c.get('b')
+        (1, None)
+        >>> c['big'] = 'x' * 1024
+        >>> 'big' in c
+        False
+    """
+
+    # slot header: 是否使用, key 的 md5, value 的长度
+    _HEADER = struct.Struct('<B16sI')
+
+    def __init__(self, slots=4096, slot_size=1024, stripes=64, probes=4):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.probes = min(probes, slots)
+        self._map = mmap.mmap(-1, slots * slot_size)
+        self._locks = [multiprocessing.Lock() for _ in xrange(stripes)]
+
+    def _digest(self, key):
+        return hashlib.md5(cPickle.dumps(key, 2)).digest()
+
+    def _probe(self, digest):
+        home = struct.unpack('<Q', digest[:8])[0]
+        for i in xrange(self.probes):
+            slot = (home + i) % self.slots
+            yield slot * self.slot_size, self._locks[slot % len(self._locks)]
+
+    def get(self, key, default=None):
+        try:
+            digest = self._digest(key)
+        except (cPickle.PicklingError, TypeError):
+            return default
+
+        header = self._HEADER
+        for offset, lock in self._probe(digest):
+            with lock:
+                used, slot_digest, length = header.unpack_from(self._map, offset)
+                if not used:
+                    return default
+                if slot_digest == digest:
+                    data = self._map[offset + header.size:offset + header.size + length]
+                    break
+        else:
+            return default
+        return cPickle.loads(data)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __setitem__(self, key, value):
+        header = self._HEADER
+        try:
+            digest = self._digest(key)
+            data = cPickle.dumps(value, 2)
+        except (cPickle.PicklingError, TypeError):
+            return
+        if header.size + len(data) > self.slot_size:
+            return
+
+        probes = list(self._probe(digest))
+        for offset, lock in probes:
+            with lock:
+                used, slot_digest, _ = header.unpack_from(self._map, offset)
+                if not used or slot_digest == digest:
+                    self._write(offset, digest, data)
+                    return
+        # 所有位置都被占用, 覆盖第一个
+        offset, lock = probes[0]
+        with lock:
+            self._write(offset, digest, data)
+
+    def _write(self, offset, digest, data):
+        header = self._HEADER
+        header.pack_into(self._map, offset, 1, digest, len(data))
+        self._map[offset + header.size:offset + header.size + len(data)] = data
+
+    def clear(self):
+        for slot in xrange(self.slots):
+            with self._locks[slot % len(self._locks)]:
+                self._map[slot * self.slot_size] = '\x00'
@@ -3,9 +3,16 @@
 # @date: 14-4-8
 
 __author__ = 'wujiabin'
+import hashlib
+import inspect
+import marshal
 import re
+import sys
 import threading
 import time
+import types
+
+from simutils.cache import DiskCache, SharedMemoryCache
 
 
 class Wrapper(object):
@@ -20,28 +27,118 @@ func = Wrapper()
 def invoked_once(func):
     """
     Decorate a method which just can be invoked only once.
-    确保方法只会被调用一次
+    确保方法只会被调用一次, 多线程下也是如此, 之后的调用返回第一次调用的结果.
+    如果调用抛出异常, 下一次调用会重新执行.
+
+        >>> calls = []
+        >>> @invoked_once
+        ... def init(x):
+        ...     calls.append(x)
+        ...     return x
+        >>> init(1), init(2), calls
+        (1, 1, [1])
     """
-    func.__called = False
+    lock = threading.Lock()
+    result = []  # 调用成功之后保存结果
 
     def wrapper(*args, **kargs):
-        #print('func_name: %r, callled: %r,' % (func.__name__, func.__called), args, kargs)
-        if func.__called:
-            return None
-        else:
-            func.__called = True
-            return func(*args, **kargs)
+        # 已经调用过就不用加锁了
+        if result:
+            return result[0]
+        with lock:
+            if not result:
+                result.append(func(*args, **kargs))
+        return result[0]
     return wrapper
 
 func.invoked_once = invoked_once
 
 
+def invoked_once_per_key(func):
+    """
+    Like `invoked_once`, but the method is invoked once for each distinct arguments.
+    不同参数的调用之间不会互相阻塞.
+
+        >>> calls = []
+        >>> @invoked_once_per_key
+        ... def connect(host):
+        ...     calls.append(host)
+        ...     return 'conn to ' + host
+        >>> connect('a'), connect('b'), connect('a'), calls
+        ('conn to a', 'conn to b', 'conn to a', ['a', 'b'])
+    """
+    lock = threading.Lock()
+    results = {}
+    key_locks = {}
+
+    def wrapper(*args, **kargs):
+        key = (args, tuple(sorted(kargs.items())))
+        try:
+            return results[key]
+        except KeyError:
+            pass
+
+        with lock:
+            key_lock = key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                if key not in results:
+                    results[key] = func(*args, **kargs)
+        finally:
+            # func 抛异常的时候也要删掉, 否则每个失败的 key 都留下一个锁
+            with lock:
+                key_locks.pop(key, None)
+        return results[key]
+    return wrapper
+
+func.invoked_once_per_key = invoked_once_per_key
+
+
+class cached_property(object):
+    """
+    A property computed once per instance, even under concurrent access.
+    The value is stored in the instance's __dict__, so later accesses are plain
+    attribute lookups. Delete the attribute to compute it again.
+
+        >>> class Foo(object):
+        ...     @cached_property
+        ...     def bar(self):
+        ...         print 'computing'
+        ...         return 42
+        >>> foo = Foo()
+        >>> foo.bar
+        computing
+        42
+        >>> foo.bar
+        42
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        # RLock: 计算的时候可能会访问其他实例的同一个属性
+        self.lock = threading.RLock()
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        with self.lock:
+            if self.name not in obj.__dict__:
+                obj.__dict__[self.name] = self.func(obj)
+            return obj.__dict__[self.name]
+
+func.cached_property = cached_property
+
+
 # 还有其他实现, 参考: https://github.com/the5fire/Python-LRU-cache
 class Memoize:
     """
     'Memoizes' a function, caching its return values for each input.
     If `expires` is specified, values are recalculated after `expires` seconds.
     If `background` is specified, values are recalculated in a separate thread.
+    If `cache` is specified, it is used to store the values instead of a dict,
+    it only needs `get` and `__setitem__`, see `simutils.cache`.
 
     COPY FROM WEB.PY
         >>> calls = 0
@@ -89,37 +186,203 @@ class Memoize:
         >>> fastcalls()
         9
     """
-    def __init__(self, func, expires=None, background=True):
+    def __init__(self, func, expires=None, background=True, cache=None):
         self.func = func
-        self.cache = {}
+        if cache is None:
+            cache = {}
+        self.cache = cache
         self.expires = expires
         self.background = background
         self.running = {}
 
     def __call__(self, *args, **keywords):
-        key = (args, tuple(keywords.items()))
+        key = (args, tuple(sorted(keywords.items())))
         if not self.running.get(key):
             self.running[key] = threading.Lock()
 
         def update(block=False):
             if self.running[key].acquire(block):
                 try:
-                    self.cache[key] = (self.func(*args, **keywords), time.time())
+                    entry = (self.func(*args, **keywords), time.time())
+                    self.cache[key] = entry
+                    return entry
                 finally:
                     self.running[key].release()
 
-        if key not in self.cache:
-            update(block=True)
-        elif self.expires and (time.time() - self.cache[key][1]) > self.expires:
+        # 只查一次 cache, 后端可能是磁盘或者共享内存
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = update(block=True)
+        elif self.expires and (time.time() - entry[1]) > self.expires:
             if self.background:
                 threading.Thread(target=update).start()
             else:
-                update()
-        return self.cache[key][0]
+                entry = update() or entry
+        return entry[0]
 
 memoize = Memoize
 func.ret_cached = Memoize
 
+
+def _func_version(f):
+    """
+    Hash of the function's source, so that cached values are dropped when the code changes.
+    """
+    try:
+        source = inspect.getsource(f)
+    except (IOError, TypeError):
+        code = getattr(f, 'func_code', None)
+        if code is None:
+            return ''
+        source = marshal.dumps(code)
+    return hashlib.sha1(source).hexdigest()
+
+
+def disk_cached(path, expires=None, background=True, max_entries=10000, hot_size=1000):
+    """
+    Like `func.ret_cached`, but the values are persisted in the sqlite database `path`,
+    so that they survive restarts. The values are versioned by the function's source,
+    editing the function invalidates them. See `simutils.cache.DiskCache`.
+
+        @func.ret_disk_cached('/tmp/memoize.db', expires=3600)
+        def derive_config(name):
+            ...
+    """
+    def decorator(f):
+        cache = DiskCache(path, name='%s.%s' % (f.__module__, f.__name__), version=_func_version(f),
+                          max_entries=max_entries, hot_size=hot_size)
+        return Memoize(f, expires, background, cache=cache)
+    return decorator
+
+func.ret_disk_cached = disk_cached
+
+
+def shm_cached(expires=None, background=True, slots=4096, slot_size=1024, stripes=64):
+    """
+    Like `func.ret_cached`, but the values are kept in shared memory, so the worker
+    processes of a pre-fork server share one warm cache. The function must be
+    decorated in the master process, before forking. See `simutils.cache.SharedMemoryCache`.
+
+        @func.ret_shm_cached(slots=1024, slot_size=4096)
+        def derive_config(name):
+            ...
+    """
+    def decorator(f):
+        cache = SharedMemoryCache(slots=slots, slot_size=slot_size, stripes=stripes)
+        return Memoize(f, expires, background, cache=cache)
+    return decorator
+
+func.ret_shm_cached = shm_cached
+
+class _Items(tuple):
+    """Items of a generator cached by `InflightMemoize`."""
+    pass
+
+
+class _Call(object):
+    """An in-flight call of `InflightMemoize`, waited on by concurrent callers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.entry
+
+
+class InflightMemoize(object):
+    """
+    'Memoizes' a function like `Memoize`, but concurrent calls with the same
+    arguments share one in-flight computation: the first caller runs the
+    function, the others wait for its result, or its exception, which is not
+    cached. Values are recalculated after `expires` seconds.
+
+    A generator can only be consumed once, so generators returned by the
+    function are drained and their items cached; every call gets a fresh
+    iterator over them. Don't use it on functions returning infinite
+    generators, draining them never ends.
+
+        >>> calls = []
+        >>> def slow(x):
+        ...     calls.append(x)
+        ...     time.sleep(.1)
+        ...     return x * 2
+        >>> f = InflightMemoize(slow, expires=.5)
+        >>> threads = [threading.Thread(target=f, args=(1,)) for _ in range(5)]
+        >>> for t in threads: t.start()
+        >>> for t in threads: t.join()
+        >>> f(1), calls
+        (2, [1])
+        >>> time.sleep(.6)
+        >>> f(1), calls
+        (2, [1, 1])
+        >>> def gen(n):
+        ...     for i in range(n):
+        ...         yield i
+        >>> g = InflightMemoize(gen)
+        >>> list(g(3)), list(g(3))
+        ([0, 1, 2], [0, 1, 2])
+    """
+
+    def __init__(self, func, expires=None, cache=None):
+        self.func = func
+        if cache is None:
+            cache = {}
+        self.cache = cache
+        self.expires = expires
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def __call__(self, *args, **keywords):
+        key = (args, tuple(sorted(keywords.items())))
+        entry = self.cache.get(key)
+        if not self._fresh(entry):
+            entry = self._compute(key, args, keywords)
+
+        value = entry[0]
+        if isinstance(value, _Items):
+            return iter(value)
+        return value
+
+    def _fresh(self, entry):
+        return entry is not None and not (self.expires and (time.time() - entry[1]) > self.expires)
+
+    def _compute(self, key, args, keywords):
+        with self.lock:
+            call = self.inflight.get(key)
+            if call is not None:
+                owner = False
+            else:
+                # 上一个 owner 可能刚刚存好结果并退出, 不要再算一次
+                entry = self.cache.get(key)
+                if self._fresh(entry):
+                    return entry
+                owner = True
+                call = self.inflight[key] = _Call()
+        if not owner:
+            return call.wait()
+
+        try:
+            value = self.func(*args, **keywords)
+            if isinstance(value, types.GeneratorType):
+                value = _Items(value)
+            call.entry = (value, time.time())
+            self.cache[key] = call.entry
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call.done.set()
+        return call.entry
+
+func.ret_cached_inflight = InflightMemoize
+
 re_compile = memoize(re.compile)  # not thread-safe
 re_compile.__doc__ = """
 A cached version of re.compile from web.py.
@@ -4,30 +4,288 @@
 
 __author__ = 'wujiabin'
 
+import random
+import threading
 import time
 import sys
+import weakref
+
+# py2 没有 perf_counter/process_time, 有的话优先使用
+CLOCKS = {
+    'wall': getattr(time, 'perf_counter', time.time),
+    'cpu': getattr(time, 'process_time', time.clock),
+}
 
 
 class Timer(object):
     """
     simple timer 可以在退出的时候打报告什么的
     """
-    def __init__(self, verbose=False, fd=sys.stdout):
+    def __init__(self, verbose=False, fd=sys.stdout, clock=time.time):
         self.verbose = verbose
         self.start = 0
         self.elapsed_ms = 0
         self._fd = fd
+        self._clock = clock
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = self._clock()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.elapsed_ms = (time.time() - self.start) * 1000
+        self.elapsed_ms = (self._clock() - self.start) * 1000
         if self.verbose:
             print >> self._fd, 'elapsed time: %f ms' % self.elapsed_ms
 
-import threading
+
+class Span(Timer):
+    """
+    A named timer of a `Profiler`, can be nested. Use it as a context manager,
+    or as a decorator. 由 Profiler.span 创建
+    """
+    def __init__(self, profiler, name):
+        Timer.__init__(self, clock=profiler.clock)
+        self.profiler = profiler
+        self.name = name
+        self.path = (name,)
+        self.children_ms = 0
+
+    def __enter__(self):
+        # 同一个 span 可以重复使用, 每次进入都重新计算
+        self.path = (self.name,)
+        self.children_ms = 0
+        stack = self.profiler._stack()
+        if stack:
+            self.path = stack[-1].path + (self.name,)
+        stack.append(self)
+        return Timer.__enter__(self)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Timer.__exit__(self, exc_type, exc_val, exc_tb)
+        stack = self.profiler._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children_ms += self.elapsed_ms
+        self.profiler._record(self.path, self.elapsed_ms, self.elapsed_ms - self.children_ms)
+
+    def __call__(self, func):
+        profiler, name = self.profiler, self.name
+
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with Span(profiler, name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+class _NullSpan(object):
+    """Span returned by a disabled Profiler, does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def __call__(self, func):
+        return func
+
+_null_span = _NullSpan()
+
+
+class _SpanStats(object):
+    __slots__ = ('count', 'total_ms', 'self_ms', 'min_ms', 'max_ms', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0
+        self.self_ms = 0
+        self.min_ms = None
+        self.max_ms = None
+        self.samples = []
+
+
+class Profiler(object):
+    """
+    Hierarchical profiler, aggregates named nested spans per thread into
+    count/total/min/max/percentiles, and exports them as collapsed stacks,
+    which can be fed to flamegraph.pl. A disabled profiler costs one attribute
+    check per span.
+
+        >>> p = Profiler()
+        >>> @p.span('db')
+        ... def query():
+        ...     pass
+        >>> with p.span('request'):
+        ...     query()
+        ...     query()
+        >>> s = p.stats()
+        >>> s['db']['count'], s['request']['count']
+        (2, 1)
+        >>> sorted(line.rsplit(' ', 1)[0] for line in p.collapsed())
+        ['request', 'request;db']
+        >>> p.enabled = False
+        >>> with p.span('request'):
+        ...     query()
+        >>> p.stats()['db']['count']
+        2
+        >>> @p.span('cold')
+        ... def cold():
+        ...     return 1
+        >>> cold()
+        1
+
+    :param clock: 'wall' or 'cpu' or a function returning seconds
+    :param max_samples: 每个 span 保留的样本数, 用于计算百分位
+    """
+
+    def __init__(self, enabled=True, clock='wall', max_samples=1000):
+        self.enabled = enabled
+        self.clock = CLOCKS.get(clock, clock)
+        self.max_samples = max_samples
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 每个线程一份统计, 记录的时候不需要加锁: [(线程的 weakref, {path: _SpanStats})]
+        self._thread_stats = []
+        # 已经结束的线程的统计合并在这里, 线程很多的时候不会一直增长
+        self._retired = {}
+
+    def span(self, name):
+        if not self.enabled:
+            return _null_span
+        return Span(self, name)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            self._local.stats = {}
+            with self._lock:
+                self._prune()
+                self._thread_stats.append((weakref.ref(threading.current_thread()), self._local.stats))
+            return self._local.stack
+
+    def _prune(self):
+        """Folds the stats of the finished threads into the retired stats, call it with the lock held."""
+        alive = []
+        for ref, stats in self._thread_stats:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                alive.append((ref, stats))
+            else:
+                for path, s in stats.items():
+                    self._merge(path, s)
+        self._thread_stats[:] = alive
+
+    def _merge(self, path, s):
+        retired = self._retired.get(path)
+        if retired is None:
+            retired = self._retired[path] = _SpanStats()
+        retired.count += s.count
+        retired.total_ms += s.total_ms
+        retired.self_ms += s.self_ms
+        if retired.min_ms is None or s.min_ms < retired.min_ms:
+            retired.min_ms = s.min_ms
+        if retired.max_ms is None or s.max_ms > retired.max_ms:
+            retired.max_ms = s.max_ms
+        samples = retired.samples + s.samples
+        if len(samples) > self.max_samples:
+            samples = random.sample(samples, self.max_samples)
+        retired.samples = samples
+
+    def _record(self, path, elapsed_ms, self_ms):
+        stats = self._local.stats.get(path)
+        if stats is None:
+            stats = self._local.stats[path] = _SpanStats()
+        stats.count += 1
+        stats.total_ms += elapsed_ms
+        stats.self_ms += self_ms
+        if stats.min_ms is None or elapsed_ms < stats.min_ms:
+            stats.min_ms = elapsed_ms
+        if stats.max_ms is None or elapsed_ms > stats.max_ms:
+            stats.max_ms = elapsed_ms
+        # reservoir sampling
+        if len(stats.samples) < self.max_samples:
+            stats.samples.append(elapsed_ms)
+        else:
+            i = random.randint(0, stats.count - 1)
+            if i < self.max_samples:
+                stats.samples[i] = elapsed_ms
+
+    def _paths(self):
+        """Merge the stats of all threads by path."""
+        with self._lock:
+            thread_stats = [stats for _, stats in self._thread_stats] + [dict(self._retired)]
+        merged = {}
+        for stats in thread_stats:
+            for path, s in stats.items():
+                merged.setdefault(path, []).append(s)
+        return merged
+
+    def stats(self):
+        """
+        Stats of every span name, in ms:
+        {name: {'count', 'total', 'self', 'min', 'max', 'p50', 'p90', 'p99'}}
+        """
+        by_name = {}
+        for path, stats in self._paths().items():
+            by_name.setdefault(path[-1], []).extend(stats)
+
+        ret = {}
+        for name, stats in by_name.items():
+            samples = sorted(x for s in stats for x in s.samples)
+
+            def percentile(p):
+                return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+            ret[name] = {
+                'count': sum(s.count for s in stats),
+                'total': sum(s.total_ms for s in stats),
+                'self': sum(s.self_ms for s in stats),
+                'min': min(s.min_ms for s in stats),
+                'max': max(s.max_ms for s in stats),
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+            }
+        return ret
+
+    def report(self):
+        """A text table of the stats, slowest spans first."""
+        lines = ['%-40s %8s %12s %12s %10s %10s %10s %10s' %
+                 ('name', 'count', 'total(ms)', 'self(ms)', 'min', 'max', 'p50', 'p99')]
+        stats = self.stats()
+        for name in sorted(stats, key=lambda n: -stats[n]['total']):
+            s = stats[name]
+            lines.append('%-40s %8d %12.3f %12.3f %10.3f %10.3f %10.3f %10.3f' %
+                         (name, s['count'], s['total'], s['self'], s['min'], s['max'], s['p50'], s['p99']))
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        """Self time of every stack in microseconds, in the collapsed stack format."""
+        lines = []
+        for path, stats in sorted(self._paths().items()):
+            us = int(sum(s.self_ms for s in stats) * 1000)
+            lines.append('%s %d' % (';'.join(path), us))
+        return lines
+
+    def write_collapsed(self, fd):
+        """Writes the collapsed stacks to the file object or path `fd`."""
+        if isinstance(fd, basestring):
+            with open(fd, 'w') as f:
+                return self.write_collapsed(f)
+        for line in self.collapsed():
+            fd.write(line + '\n')
+
+    def clear(self):
+        with self._lock:
+            for _, stats in self._thread_stats:
+                stats.clear()
+            self._retired.clear()
+
 import Queue
 
 
@@ -31,24 +31,45 @@ Grammar:
 """
 
 __all__ = [
-    "Template",
+    "Template", "Markup", "ESCAPE_FILTERS",
     "Render", "render", "frender",
-    "ParseError", "SecurityError",
+    "BytecodeCache", "TemplateCache", "FragmentCache", "fragment_cache",
+    "DependencyGraph", "Loader", "DirectoryLoader", "DictLoader", "ZipLoader", "ChainLoader", "TemplateProfiler",
+    "RenderLimits", "ParseError", "SecurityError", "LimitExceeded",
     "test"
 ]
 
 import tokenize
+import ast
 import os
 import sys
-import glob
+import codecs
+import hashlib
+import imp
+import itertools
+import marshal
+import Queue
 import re
+import tempfile
+import threading
+import time
+import types
+import zipfile
 from UserDict import DictMixin
 import warnings
 
-from simutils.decorators import func
-from simutils.utils import storage, safeunicode, safestr, websafe
+from simutils.decorators import func, Profiler
+from simutils.utils import storage, safeunicode, safestr, websafe, htmlquote, jsquote, urlquote, LimitedSizeDict
 
 re_compile = func.ret_cached(re.compile)
+re_spaces = re.compile(' *')
+re_indent = re.compile('  +')
+re_whitespace = re.compile('[ \f\t]*')
+re_loop = re.compile(r'\bloop\b')
+re_extends = re.compile(r'^[ \t]*\$extends[ \t]+(.*?)[ \t]*$', re.M)
+
+# 修改了代码生成或者安全检查之后需要修改这个版本号, 让 BytecodeCache 里的旧代码失效
+ENGINE_VERSION = '7'
 
 
 def splitline(text):
@@ -68,28 +89,251 @@ def splitline(text):
     else:
         return text, ''
 
+def lineend(text, pos=0):
+    r"""
+    Returns the index just after the newline ending the line at `pos`.
+
+        >>> lineend('foo\nbar')
+        4
+        >>> lineend('foo\nbar', 4)
+        7
+    """
+    return text.find('\n', pos) + 1 or len(text)
+
+class Token(object):
+    """A python token of the template text, `begin` and `end` are offsets into the text."""
+    __slots__ = ('type', 'value', 'begin', 'end')
+
+    def __init__(self, type, value, begin, end):
+        self.type = type
+        self.value = value
+        self.begin = begin
+        self.end = end
+
+    def __repr__(self):
+        return '<token %s %r>' % (tokenize.tok_name.get(self.type, self.type), self.value)
+
+# type of the tokens standing for the spaces between python tokens
+SPACE = -1
+
+class Lexer:
+    r"""Python tokenizer over the whole template text.
+
+    Tokens are scanned on demand with the regular expressions of the tokenize module,
+    directly at offsets into the text, and the recent ones are kept by offset, so
+    that the lookahead, the statement and the expressions of a section share one
+    token stream.
+
+        >>> lexer = Lexer('$for i in range(10): $i\n')
+        >>> lexer.first(1)
+        <token NAME 'for'>
+        >>> lexer.token(4), lexer.token(6)
+        (<token NAME 'i'>, <token NAME 'in'>)
+        >>> lexer.first(20)
+        <token INDENT ' '>
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = {}
+
+    def token(self, pos):
+        """Returns the token at `pos`, skipping the spaces before it."""
+        t = self.tokens.get(pos)
+        if t is None:
+            # only the tokens of the current section are read again, keep the cache small
+            if len(self.tokens) > 256:
+                self.tokens.clear()
+            t = self.tokens[pos] = self.scan(pos)
+        return t
+
+    def first(self, pos, end=None):
+        """Returns the first token of the line starting at `pos`, like tokenize does for a new line:
+        leading spaces are an INDENT, a comment or a blank line is not a statement.
+        """
+        text = self.text
+        if end is None:
+            end = lineend(text, pos)
+        index = re_whitespace.match(text, pos, end).end()
+        if index == end:
+            return Token(tokenize.ENDMARKER, '', end, end)
+        elif text[index] == '#':
+            value = text[index:end].rstrip('\r\n')
+            return Token(tokenize.COMMENT, value, index, index + len(value))
+        elif text[index] in '\r\n':
+            return Token(tokenize.NL, text[index:end], index, end)
+        elif index > pos:
+            return Token(tokenize.INDENT, text[pos:index], pos, index)
+        else:
+            return self.token(pos)
+
+    def scan(self, pos):
+        text = self.text
+        while True:
+            match = tokenize.pseudoprog.match(text, pos)
+            if match is None:
+                return Token(tokenize.ERRORTOKEN, text[pos], pos, pos + 1)
+
+            begin, end = match.span(1)
+            if begin == end:
+                return Token(tokenize.ENDMARKER, '', end, end)
+
+            token, initial = text[begin:end], text[begin]
+            if initial in NUMCHARS or (initial == '.' and token != '.'):
+                return Token(tokenize.NUMBER, token, begin, end)
+            elif initial in '\r\n':
+                return Token(tokenize.NEWLINE, token, begin, end)
+            elif initial == '#':
+                return Token(tokenize.COMMENT, token, begin, end)
+            elif token in tokenize.triple_quoted:
+                return self.scan_string(begin, end, tokenize.endprogs[token])
+            elif initial in tokenize.single_quoted or \
+                token[:2] in tokenize.single_quoted or \
+                token[:3] in tokenize.single_quoted:
+                if token[-1] == '\n': # continued string
+                    endprog = (tokenize.endprogs[initial] or tokenize.endprogs[token[1]] or
+                               tokenize.endprogs[token[2]])
+                    return self.scan_string(begin, end, endprog, True)
+                return Token(tokenize.STRING, token, begin, end)
+            elif initial in NAMECHARS:
+                return Token(tokenize.NAME, token, begin, end)
+            elif initial == '\\': # continued statement
+                pos = end
+            else:
+                return Token(tokenize.OP, token, begin, end)
+
+    def scan_string(self, begin, end, endprog, needcont=False):
+        r"""Scans the rest of a string continued on the next lines. Like
+        tokenize, a single quoted string which reaches a line not ending
+        with a backslash is an ERRORTOKEN up to the end of that line. An
+        unterminated string is an ERRORTOKEN up to the end of the text,
+        which ends the snippet it starts in instead of raising TokenError.
+
+            >>> lexer = Lexer("name's page \\\nand more\n")
+            >>> lexer.token(4)
+            <token ERRORTOKEN "'s page \\\nand more\n">
+            >>> unicode(Template("$def with (name)\nThis is $name's page \\\nand more\n")('bob'))
+            u"This is bob's page and more\n"
+        """
+        text = self.text
+        if not needcont:
+            match = endprog.match(text, end)
+            if match is None:
+                return Token(tokenize.ERRORTOKEN, text[begin:], begin, len(text))
+            return Token(tokenize.STRING, text[begin:match.end()], begin, match.end())
+
+        # tokenize 每次只读一行, 结束的引号要在同一行里
+        pos = end
+        while pos < len(text):
+            stop = lineend(text, pos)
+            match = endprog.match(text, pos, stop)
+            if match is not None:
+                return Token(tokenize.STRING, text[begin:match.end()], begin, match.end())
+            if not (text.endswith('\\\n', pos, stop) or text.endswith('\\\r\n', pos, stop)):
+                return Token(tokenize.ERRORTOKEN, text[begin:stop], begin, stop)
+            pos = stop
+        return Token(tokenize.ERRORTOKEN, text[begin:], begin, len(text))
+
+NAMECHARS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_')
+NUMCHARS = set('0123456789')
+
+class TokenStream:
+    """The tokens of a python snippet in text[begin:end], as the python tokenizer returns them
+    for that single line, with SPACE tokens for the spaces between tokens.
+    Supports 2 look aheads.
+    """
+    def __init__(self, lexer, begin, end):
+        self.lexer = lexer
+        self.pos = begin
+        self.end = end
+        self.depth = 0
+        self.items = []
+        self.position = 0
+        self.current_item = None
+
+    def _next(self):
+        if self.current_item is None and not self.items:
+            t = self.lexer.first(self.pos, self.end)
+        elif self.pos >= self.end:
+            # 不要读后面的行, 那里可能是没有结束的字符串
+            t = Token(tokenize.ENDMARKER, '', self.end, self.end)
+        else:
+            t = self.lexer.token(self.pos)
+            if t.begin > self.pos and t.begin < self.end:
+                space = Token(SPACE, self.lexer.text[self.pos:t.begin], self.pos, t.begin)
+                self.pos = t.begin
+                return space
+
+        if t.type == tokenize.ENDMARKER or t.end > self.end:
+            if self.depth:
+                raise tokenize.TokenError("EOF in multi-line statement", self.end)
+            return Token(tokenize.ENDMARKER, '', self.end, self.end)
+
+        if t.type == tokenize.OP:
+            if t.value in '([{':
+                self.depth += 1
+            elif t.value in ')]}':
+                self.depth -= 1
+        self.pos = t.end
+        return t
+
+    def lookahead(self):
+        if len(self.items) <= self.position:
+            self.items.append(self._next())
+        return self.items[self.position]
+
+    def lookahead2(self):
+        while len(self.items) <= self.position+1:
+            self.items.append(self._next())
+        return self.items[self.position+1]
+
+    def next(self):
+        self.current_item = self.lookahead()
+        self.position += 1
+        return self.current_item
+
 class Parser:
     """Parser Base.
+
+    The parser works on offsets into the template text: every read_xxx_at method
+    takes the text and a position and returns the node and the position after it,
+    so that the rest of the template is never copied. The read_xxx methods are the
+    same operations on a text, returning the remaining text.
+
+    The python snippets ($expr, statements) are tokenized by a `Lexer` over the
+    whole text.
     """
     def __init__(self):
         self.statement_nodes = STATEMENT_NODES
         self.keywords = KEYWORDS
+        self.lexers = {}
+
+    def get_lexer(self, text):
+        lexer = self.lexers.get(id(text))
+        if lexer is None or lexer.text is not text:
+            if len(self.lexers) > 8:
+                self.lexers.clear()
+            lexer = self.lexers[id(text)] = Lexer(text)
+        return lexer
 
     def parse(self, text, name="<template>"):
         self.text = text
         self.name = name
 
-        defwith, text = self.read_defwith(text)
-        suite = self.read_suite(text)
+        defwith, pos = self.read_defwith_at(text, 0)
+        suite = self.read_suite_at(text, pos)
         return DefwithNode(defwith, suite)
 
     def read_defwith(self, text):
-        if text.startswith('$def with'):
-            defwith, text = splitline(text)
-            defwith = defwith[1:].strip() # strip $ and spaces
-            return defwith, text
+        defwith, pos = self.read_defwith_at(text, 0)
+        return defwith, text[pos:]
+
+    def read_defwith_at(self, text, pos):
+        if text.startswith('$def with', pos):
+            end = lineend(text, pos)
+            defwith = text[pos+1:end].strip() # strip $ and spaces
+            return defwith, end
         else:
-            return '', text
+            return '', pos
 
     def read_section(self, text):
         r"""Reads one section from the given text.
@@ -104,22 +348,48 @@ class Parser:
 
         read_section('$for in range(10):\n    hello $i\nfoo)
         """
-        if text.lstrip(' ').startswith('$'):
-            index = text.index('$')
-            begin_indent, text2 = text[:index], text[index+1:]
-            ahead = self.python_lookahead(text2)
+        node, pos = self.read_section_at(text, 0)
+        return node, text[pos:]
+
+    def read_section_at(self, text, pos):
+        index = re_spaces.match(text, pos).end()
+        if text.startswith('$', index):
+            begin_indent = text[pos:index]
+            ahead = self.python_lookahead_at(text, index+1)
 
+            if ahead in NAME_STATEMENTS and not self.is_statement_at(text, index+1, ahead):
+                return self.readline_at(text, pos)
             if ahead == 'var':
-                return self.read_var(text2)
+                return self.read_var_at(text, index+1)
+            elif ahead == 'extends':
+                return self.read_extends_at(text, index+1)
             elif ahead in self.statement_nodes:
-                return self.read_block_section(text2, begin_indent)
+                return self.read_block_section_at(text, index+1, begin_indent)
             elif ahead in self.keywords:
-                return self.read_keyword(text2)
+                return self.read_keyword_at(text, index+1)
             elif ahead.strip() == '':
                 # assignments starts with a space after $
                 # ex: $ a = b + 2
-                return self.read_assignment(text2)
-        return self.readline(text)
+                return self.read_assignment_at(text, index+1)
+        return self.readline_at(text, pos)
+
+    def is_statement_at(self, text, pos, keyword):
+        r"""`cache`, `block` and `extends` may also be variables: they start a
+        statement only when followed by a space, and the block statements
+        only when the line ends with a colon.
+
+            >>> t = Template('$def with (cache, block)\n$cache.x $block[0]\n$cache "k", 60: hi\n', fragment_cache=FragmentCache())
+            >>> unicode(t(storage(x=1), [2]))
+            u'1 2\nhi\n'
+        """
+        end = lineend(text, pos)
+        rest = text[pos + len(keyword):end]
+        if not rest[:1].isspace() or not rest.strip():
+            return False
+        if keyword in self.statement_nodes:
+            stmt, _ = self.read_statement_at(text, pos, end)
+            return stmt.rstrip().endswith(':')
+        return True
 
     def read_var(self, text):
         r"""Reads a var statement.
@@ -128,36 +398,55 @@ class Parser:
             >>> read_var('var x=10\nfoo')
             (<var: x = 10>, 'foo')
             >>> read_var('var x: hello $name\nfoo')
-            (<var: x = join_(u'hello ', escape_(name, True))>, 'foo')
+            (<var: x = join_(u'hello ', esc_(name, True))>, 'foo')
         """
-        line, text = splitline(text)
-        tokens = self.python_tokens(line)
+        node, pos = self.read_var_at(text, 0)
+        return node, text[pos:]
+
+    def read_var_at(self, text, pos):
+        end = lineend(text, pos)
+        tokens = self.python_tokens_at(text, pos, end)
         if len(tokens) < 4:
             raise SyntaxError('Invalid var statement')
 
-        name = tokens[1]
+        name = tokens[1].value
         sep = tokens[2]
-        value = line.split(sep, 1)[1].strip()
 
-        if sep == '=':
-            pass # no need to process value
-        elif sep == ':':
+        if sep.value == '=':
+            value = text[sep.end:end].strip()
+        elif sep.value == ':':
             #@@ Hack for backward-compatability
-            if tokens[3] == '\n': # multi-line var statement
-                block, text = self.read_indented_block(text, '    ')
+            if tokens[3].value == '\n': # multi-line var statement
+                block, end = self.read_indented_block_at(text, end, '    ')
                 lines = [self.readline(x)[0] for x in block.splitlines()]
                 nodes = []
                 for x in lines:
                     nodes.extend(x.nodes)
                     nodes.append(TextNode('\n'))
             else: # single-line var statement
-                linenode, _ = self.readline(value)
-                nodes = linenode.nodes
+                begin = re_whitespace.match(text, sep.end).end()
+                nodes = self.read_nodes_at(text, begin, pos + len(text[pos:end].rstrip()))
             parts = [node.emit('') for node in nodes]
             value = "join_(%s)" % ", ".join(parts)
         else:
             raise SyntaxError('Invalid var statement')
-        return VarNode(name, value), text
+        return VarNode(name, value), end
+
+    def read_extends_at(self, text, pos):
+        r"""Reads an extends statement.
+
+            >>> Parser().read_extends_at("extends 'layout'\nfoo", 0)
+            (<extends: 'layout'>, 17)
+        """
+        end = lineend(text, pos)
+        expr = text[pos + len('extends'):end].strip()
+        try:
+            name = ast.literal_eval(expr)
+        except (SyntaxError, ValueError):
+            name = None
+        if not isinstance(name, basestring):
+            raise ParseError, '$extends needs the name of a template as a string: %s' % expr
+        return ExtendsNode(name), end
 
     def read_suite(self, text):
         r"""Reads section by section till end of text.
@@ -166,9 +455,13 @@ class Parser:
             >>> read_suite('hello $name\nfoo\n')
             [<line: [t'hello ', $name, t'\n']>, <line: [t'foo\n']>]
         """
+        return self.read_suite_at(text, 0)
+
+    def read_suite_at(self, text, pos):
         sections = []
-        while text:
-            section, text = self.read_section(text)
+        end = len(text)
+        while pos < end:
+            section, pos = self.read_section_at(text, pos)
             sections.append(section)
         return SuiteNode(sections)
 
@@ -183,18 +476,25 @@ class Parser:
             >>> readline('$f()\n\n')
             (<line: [$f(), t'\n']>, '\n')
         """
-        line, text = splitline(text)
+        node, pos = self.readline_at(text, 0)
+        return node, text[pos:]
+
+    def readline_at(self, text, pos):
+        end = lineend(text, pos)
 
         # supress new line if line ends with \
-        if line.endswith('\\\n'):
-            line = line[:-2]
+        if text.startswith('\\\n', end - 2) and end - 2 >= pos:
+            nodes = self.read_nodes_at(text, pos, end - 2)
+        else:
+            nodes = self.read_nodes_at(text, pos, end)
+        return LineNode(nodes), end
 
+    def read_nodes_at(self, text, pos, end):
         nodes = []
-        while line:
-            node, line = self.read_node(line)
+        while pos < end:
+            node, pos = self.read_node_at(text, pos, end)
             nodes.append(node)
-
-        return LineNode(nodes), text
+        return nodes
 
     def read_node(self, text):
         r"""Reads a node from the given text and returns the node and remaining text.
@@ -205,21 +505,24 @@ class Parser:
             >>> read_node('$name')
             ($name, '')
         """
-        if text.startswith('$$'):
-            return TextNode('$'), text[2:]
-        elif text.startswith('$#'): # comment
-            line, text = splitline(text)
-            return TextNode('\n'), text
-        elif text.startswith('$'):
-            text = text[1:] # strip $
-            if text.startswith(':'):
+        node, pos = self.read_node_at(text, 0, len(text))
+        return node, text[pos:]
+
+    def read_node_at(self, text, pos, end):
+        if text.startswith('$$', pos, end):
+            return TextNode('$'), pos + 2
+        elif text.startswith('$#', pos, end): # comment
+            return TextNode('\n'), end
+        elif text.startswith('$', pos, end):
+            pos += 1 # strip $
+            if text.startswith(':', pos, end):
                 escape = False
-                text = text[1:] # strip :
+                pos += 1 # strip :
             else:
                 escape = True
-            return self.read_expr(text, escape=escape)
+            return self.read_expr_at(text, pos, end, escape=escape)
         else:
-            return self.read_text(text)
+            return self.read_text_at(text, pos, end)
 
     def read_text(self, text):
         r"""Reads a text node from the given text.
@@ -228,15 +531,23 @@ class Parser:
             >>> read_text('hello $name')
             (t'hello ', '$name')
         """
-        index = text.find('$')
+        node, pos = self.read_text_at(text, 0, len(text))
+        return node, text[pos:]
+
+    def read_text_at(self, text, pos, end):
+        index = text.find('$', pos, end)
         if index < 0:
-            return TextNode(text), ''
+            return TextNode(text[pos:end]), end
         else:
-            return TextNode(text[:index]), text[index:]
+            return TextNode(text[pos:index]), index
 
     def read_keyword(self, text):
-        line, text = splitline(text)
-        return StatementNode(line.strip() + "\n"), text
+        node, pos = self.read_keyword_at(text, 0)
+        return node, text[pos:]
+
+    def read_keyword_at(self, text, pos):
+        end = lineend(text, pos)
+        return StatementNode(text[pos:end].strip() + "\n"), end
 
     def read_expr(self, text, escape=True):
         """Reads a python expression from the text and returns the expression and remaining text.
@@ -261,6 +572,10 @@ class Parser:
             >>> read_expr('a[1, 2][:3].f(1+2, "weird string[).", 3 + 4) done.')
             ($a[1, 2][:3].f(1+2, "weird string[).", 3 + 4), ' done.')
         """
+        node, pos = self.read_expr_at(text, 0, len(text), escape=escape)
+        return node, text[pos:]
+
+    def read_expr_at(self, text, pos, end, escape=True):
         def simple_expr():
             identifier()
             extended_expr()
@@ -270,9 +585,7 @@ class Parser:
 
         def extended_expr():
             lookahead = tokens.lookahead()
-            if lookahead is None:
-                return
-            elif lookahead.value == '.':
+            if lookahead.value == '.':
                 attr_access()
             elif lookahead.value in parens:
                 paren_expr()
@@ -281,9 +594,7 @@ class Parser:
                 return
 
         def attr_access():
-            from token import NAME # python token constants
-            dot = tokens.lookahead()
-            if tokens.lookahead2().type == NAME:
+            if tokens.lookahead2().type == tokenize.NAME:
                 tokens.next() # consume dot
                 identifier()
                 extended_expr()
@@ -306,60 +617,14 @@ class Parser:
             "{": "}"
         }
 
-        def get_tokens(text):
-            """tokenize text using python tokenizer.
-            Python tokenizer ignores spaces, but they might be important in some cases.
-            This function introduces dummy space tokens when it identifies any ignored space.
-            Each token is a storage object containing type, value, begin and end.
-            """
-            readline = iter([text]).next
-            end = None
-            for t in tokenize.generate_tokens(readline):
-                t = storage(type=t[0], value=t[1], begin=t[2], end=t[3])
-                if end is not None and end != t.begin:
-                    _, x1 = end
-                    _, x2 = t.begin
-                    yield storage(type=-1, value=text[x1:x2], begin=end, end=t.begin)
-                end = t.end
-                yield t
-
-        class BetterIter:
-            """Iterator like object with 2 support for 2 look aheads."""
-            def __init__(self, items):
-                self.iteritems = iter(items)
-                self.items = []
-                self.position = 0
-                self.current_item = None
-
-            def lookahead(self):
-                if len(self.items) <= self.position:
-                    self.items.append(self._next())
-                return self.items[self.position]
-
-            def _next(self):
-                try:
-                    return self.iteritems.next()
-                except StopIteration:
-                    return None
-
-            def lookahead2(self):
-                if len(self.items) <= self.position+1:
-                    self.items.append(self._next())
-                return self.items[self.position+1]
-
-            def next(self):
-                self.current_item = self.lookahead()
-                self.position += 1
-                return self.current_item
-
-        tokens = BetterIter(get_tokens(text))
+        tokens = TokenStream(self.get_lexer(text), pos, end)
 
         if tokens.lookahead().value in parens:
             paren_expr()
         else:
             simple_expr()
-        row, col = tokens.current_item.end
-        return ExpressionNode(text[:col], escape=escape), text[col:]
+        expr_end = tokens.current_item.end
+        return ExpressionNode(text[pos:expr_end], escape=escape), expr_end
 
     def read_assignment(self, text):
         r"""Reads assignment statement from text.
@@ -368,8 +633,12 @@ class Parser:
             >>> read_assignment('a = b + 1\nfoo')
             (<assignment: 'a = b + 1'>, 'foo')
         """
-        line, text = splitline(text)
-        return AssignmentNode(line.strip()), text
+        node, pos = self.read_assignment_at(text, 0)
+        return node, text[pos:]
+
+    def read_assignment_at(self, text, pos):
+        end = lineend(text, pos)
+        return AssignmentNode(text[pos:end].strip()), end
 
     def python_lookahead(self, text):
         """Returns the first python token from the given text.
@@ -382,14 +651,23 @@ class Parser:
             >>> python_lookahead(' x = 1')
             ' '
         """
-        readline = iter([text]).next
-        tokens = tokenize.generate_tokens(readline)
-        return tokens.next()[1]
+        return self.python_lookahead_at(text, 0)
+
+    def python_lookahead_at(self, text, pos):
+        return self.get_lexer(text).first(pos).value
 
     def python_tokens(self, text):
-        readline = iter([text]).next
-        tokens = tokenize.generate_tokens(readline)
-        return [t[1] for t in tokens]
+        return [t.value for t in self.python_tokens_at(text, 0, len(text))]
+
+    def python_tokens_at(self, text, pos, end):
+        tokens = TokenStream(self.get_lexer(text), pos, end)
+        ret = []
+        while True:
+            t = tokens.next()
+            if t.type != SPACE:
+                ret.append(t)
+            if t.type == tokenize.ENDMARKER:
+                return ret
 
     def read_indented_block(self, text, indent):
         r"""Read a block of text. A block is what typically follows a for or it statement.
@@ -403,20 +681,26 @@ class Parser:
             >>> read_indented_block('  a\n\n    b\nc', '  ')
             ('a\n\n  b\n', 'c')
         """
+        block, pos = self.read_indented_block_at(text, 0, indent)
+        return block, text[pos:]
+
+    def read_indented_block_at(self, text, pos, indent):
         if indent == '':
-            return '', text
+            return '', pos
 
-        block = ""
-        while text:
-            line, text2 = splitline(text)
+        block = []
+        end = len(text)
+        while pos < end:
+            next = lineend(text, pos)
+            line = text[pos:next]
             if line.strip() == "":
-                block += '\n'
+                block.append('\n')
             elif line.startswith(indent):
-                block += line[len(indent):]
+                block.append(line[len(indent):])
             else:
                 break
-            text = text2
-        return block, text
+            pos = next
+        return "".join(block), pos
 
     def read_statement(self, text):
         r"""Reads a python statement.
@@ -425,9 +709,13 @@ class Parser:
             >>> read_statement('for i in range(10): hello $name')
             ('for i in range(10):', ' hello $name')
         """
-        tok = PythonTokenizer(text)
+        stmt, pos = self.read_statement_at(text, 0, len(text))
+        return stmt, text[pos:]
+
+    def read_statement_at(self, text, pos, end):
+        tok = PythonTokenizer(text, pos, end, lexer=self.get_lexer(text))
         tok.consume_till(':')
-        return text[:tok.index], text[tok.index:]
+        return text[pos:tok.index], tok.index
 
     def read_block_section(self, text, begin_indent=''):
         r"""
@@ -439,22 +727,22 @@ class Parser:
             >>> read_block_section('for i in range(10):\n  hello $i\nfoo')
             (<block: 'for i in range(10):', [<line: [t'hello ', $i, t'\n']>]>, 'foo')
         """
-        line, text = splitline(text)
-        stmt, line = self.read_statement(line)
-        keyword = self.python_lookahead(stmt)
+        node, pos = self.read_block_section_at(text, 0, begin_indent)
+        return node, text[pos:]
+
+    def read_block_section_at(self, text, pos, begin_indent=''):
+        end = lineend(text, pos)
+        stmt, index = self.read_statement_at(text, pos, end)
+        keyword = self.python_lookahead_at(text, pos)
 
         # if there is some thing left in the line
+        line = text[index:end]
         if line.strip():
             block = line.lstrip()
         else:
-            def find_indent(text):
-                rx = re_compile('  +')
-                match = rx.match(text)
-                first_indent = match and match.group(0)
-                return first_indent or ""
-
             # find the indentation of the block by looking at the first line
-            first_indent = find_indent(text)[len(begin_indent):]
+            match = re_indent.match(text, end)
+            first_indent = (match and match.group(0) or "")[len(begin_indent):]
 
             #TODO: fix this special case
             if keyword == "code":
@@ -462,9 +750,9 @@ class Parser:
             else:
                 indent = begin_indent + min(first_indent, INDENT)
 
-            block, text = self.read_indented_block(text, indent)
+            block, end = self.read_indented_block_at(text, end, indent)
 
-        return self.create_block_node(keyword, stmt, block, begin_indent), text
+        return self.create_block_node(keyword, stmt, block, begin_indent), end
 
     def create_block_node(self, keyword, stmt, block, begin_indent):
         if keyword in self.statement_nodes:
@@ -473,12 +761,13 @@ class Parser:
             raise ParseError, 'Unknown statement: %s' % repr(keyword)
 
 class PythonTokenizer:
-    """Utility wrapper over python tokenizer."""
-    def __init__(self, text):
+    """Utility wrapper over the template lexer."""
+    def __init__(self, text, pos=0, end=None, lexer=None):
         self.text = text
-        readline = iter([text]).next
-        self.tokens = tokenize.generate_tokens(readline)
-        self.index = 0
+        if end is None:
+            end = len(text)
+        self.tokens = TokenStream(lexer or Lexer(text), pos, end)
+        self.index = pos
 
     def consume_till(self, delim):
         """Consumes tokens till colon.
@@ -516,13 +805,17 @@ class PythonTokenizer:
             return
 
     def next(self):
-        type, t, begin, end, line = self.tokens.next()
-        row, col = end
-        self.index = col
-        return storage(type=type, value=t, begin=begin, end=end)
+        t = self.tokens.next()
+        while t.type == SPACE:
+            t = self.tokens.next()
+        if t.type == tokenize.ENDMARKER:
+            raise StopIteration
+        self.index = t.end
+        return t
 
 class DefwithNode:
     def __init__(self, defwith, suite):
+        self.signature = defwith
         if defwith:
             self.defwith = defwith.replace('with', '__template__') + ':'
             # offset 4 lines. for encoding, __lineoffset__, loop and self.
@@ -533,7 +826,7 @@ class DefwithNode:
             self.defwith += "\n    __lineoffset__ = -5"
 
         self.defwith += "\n    loop = ForLoop()"
-        self.defwith += "\n    self = TemplateResult(); extend_ = self.extend"
+        self.defwith += "\n    self = TemplateResult(); extend_ = self.extend; esc_ = escape_"
         self.suite = suite
         self.end = "\n    return self"
 
@@ -565,7 +858,8 @@ class ExpressionNode:
         self.escape = escape
 
     def emit(self, indent, begin_indent=''):
-        return 'escape_(%s, %s)' % (self.value, bool(self.escape))
+        # esc_ 是函数开头保存的 escape_ 的局部变量, 比查找全局变量快
+        return 'esc_(%s, %s)' % (self.value, bool(self.escape))
 
     def __repr__(self):
         if self.escape:
@@ -589,17 +883,58 @@ class LineNode:
         self.nodes = nodes
 
     def emit(self, indent, text_indent='', name=''):
-        text = [node.emit('') for node in self.nodes]
-        if text_indent:
-            text = [repr(text_indent)] + text
+        return indent + "extend_([%s])\n" % join_items(self.items(text_indent))
 
-        return indent + "extend_([%s])\n" % ", ".join(text)
+    def items(self, text_indent=''):
+        """Returns the python code of the parts of the line as (code, is_literal) pairs."""
+        items = [(node.emit(''), isinstance(node, TextNode)) for node in self.nodes]
+        if text_indent:
+            items.insert(0, (repr(text_indent), True))
+        return items
 
     def __repr__(self):
         return "<line: %s>" % repr(self.nodes)
 
 INDENT = '    ' # 4 spaces
 
+def join_items(items):
+    """Joins the (code, is_literal) items of a line. Adjacent string literals
+    are only separated by a space, python concatenates them at compile time.
+
+        >>> join_items([("u'a'", True), ("u'b'", True), ('esc_(x, True)', False), ("u'c'", True)])
+        "u'a' u'b', esc_(x, True), u'c'"
+    """
+    out = []
+    prev = False
+    for code, literal in items:
+        if out:
+            out.append(prev and literal and ' ' or ', ')
+        out.append(code)
+        prev = literal
+    return ''.join(out)
+
+def emit_lines(lines, indent, text_indent=''):
+    r"""Emits consecutive lines as a single extend_ call. Each template line
+    stays on its own physical line, so line numbers in tracebacks still
+    match the template.
+
+        >>> lines = [LineNode([TextNode('a\n')]), LineNode([TextNode('b'), ExpressionNode('x'), TextNode('\n')])]
+        >>> print emit_lines(lines, '    '),
+            extend_([u'a\n'
+                u'b', esc_(x, True), u'\n'])
+    """
+    out = []
+    prev = False
+    for line in lines:
+        items = line.items(text_indent)
+        if not items:
+            continue
+        if out:
+            out.append((not (prev and items[0][1]) and ',' or '') + '\n' + indent + INDENT)
+        out.append(join_items(items))
+        prev = items[-1][1]
+    return indent + "extend_([%s])\n" % ''.join(out)
+
 class BlockNode:
     def __init__(self, stmt, block, begin_indent=''):
         self.stmt = stmt
@@ -615,18 +950,122 @@ class BlockNode:
         return "<block: %s, %s>" % (repr(self.stmt), repr(self.suite))
 
 class ForNode(BlockNode):
+    r"""
+        >>> ForNode('for i in x:', '$i\n').stmt
+        'for i in x:'
+        >>> ForNode('for i in x:', '$loop.index $i\n').stmt
+        'for i in loop.setup(x):'
+    """
+    def __init__(self, stmt, block, begin_indent=''):
+        self.original_stmt = stmt
+        # 循环体里没有用到 loop 的时候不需要 loop.setup
+        if re_loop.search(block):
+            tok = PythonTokenizer(stmt)
+            tok.consume_till('in')
+            a = stmt[:tok.index] # for i in
+            b = stmt[tok.index:-1] # rest of for stmt excluding :
+            stmt = a + ' loop.setup(' + b.strip() + '):'
+        BlockNode.__init__(self, stmt, block, begin_indent)
+
+    def __repr__(self):
+        return "<block: %s, %s>" % (repr(self.original_stmt), repr(self.suite))
+
+class CacheNode(BlockNode):
+    r"""Block whose output is cached in the template's FragmentCache.
+
+        $cache key, ttl:
+            ...
+
+    compiles to a loop which runs the body only when `key` is not cached:
+
+        >>> Parser().read_block_section("cache 'nav', 60:\n    <nav>$x</nav>\n")[0].stmt
+        "for __cache__ in cache_(self, 'nav', 60):"
+    """
     def __init__(self, stmt, block, begin_indent=''):
         self.original_stmt = stmt
-        tok = PythonTokenizer(stmt)
-        tok.consume_till('in')
-        a = stmt[:tok.index] # for i in
-        b = stmt[tok.index:-1] # rest of for stmt excluding :
-        stmt = a + ' loop.setup(' + b.strip() + '):'
+        args = stmt.strip()[len('cache'):-1].strip()
+        stmt = 'for __cache__ in cache_(self, %s):' % args
         BlockNode.__init__(self, stmt, block, begin_indent)
 
     def __repr__(self):
         return "<block: %s, %s>" % (repr(self.original_stmt), repr(self.suite))
 
+class TemplateBlockNode(BlockNode):
+    """`$block name:` section, which templates extending this one can
+    replace by a block of the same name. The default body is emitted in
+    an `if 1:` block, which the compiler removes."""
+    def __init__(self, stmt, block, begin_indent=''):
+        self.original_stmt = stmt
+        self.name = stmt.strip()[len('block'):-1].strip()
+        if not re_compile(r'^[A-Za-z_]\w*$').match(self.name):
+            raise ParseError, 'Invalid block name: %s' % repr(self.name)
+        BlockNode.__init__(self, 'if 1:', block, begin_indent)
+
+    def __repr__(self):
+        return "<block: %s, %s>" % (repr(self.original_stmt), repr(self.suite))
+
+class ExtendsNode:
+    def __init__(self, name):
+        self.name = name
+
+    def emit(self, indent, text_indent=''):
+        # 保持行号不变
+        return indent + "pass\n"
+
+    def __repr__(self):
+        return "<extends: %s>" % repr(self.name)
+
+def _template_blocks(suite, blocks):
+    for s in suite.sections:
+        if isinstance(s, TemplateBlockNode):
+            blocks[s.name] = s
+        if isinstance(s, BlockNode):
+            _template_blocks(s.suite, blocks)
+    return blocks
+
+def _replace_blocks(suite, blocks):
+    for s in suite.sections:
+        if isinstance(s, TemplateBlockNode) and s.name in blocks:
+            s.suite = blocks[s.name].suite
+        elif isinstance(s, BlockNode):
+            _replace_blocks(s.suite, blocks)
+
+def extend_template(root, loader, parser, seen=()):
+    r"""Resolves the `$extends` of the parse tree `root` at compile time:
+    returns the tree of the parent template with its `$block`s replaced by
+    the blocks of the same name of `root`. The other text of `root` is
+    ignored; its $var, $code, $def and assignments run before the parent.
+
+        >>> loader = DictLoader({'layout.html': '<h1>\n$block title: Title\n</h1>\n$block body:\n    <p>empty</p>\n'})
+        >>> t = Template("$def with (x)\n$extends 'layout'\n$block body:\n    <p>$x</p>\n", loader=loader)
+        >>> print t('hello')
+        <h1>
+        Title
+        </h1>
+        <p>hello</p>
+        <BLANKLINE>
+    """
+    extends = [s for s in root.suite.sections if isinstance(s, ExtendsNode)]
+    if not extends:
+        return root
+    if len(extends) > 1:
+        raise ParseError, 'Only one $extends is allowed in a template'
+    name = extends[0].name
+    filename = loader and loader.find(name)
+    if not filename:
+        raise ParseError, 'No template named %s to extend' % name
+    if filename in seen:
+        raise ParseError, 'Circular $extends of %s' % filename
+
+    parent = parser.parse(Template.normalize_text(loader.load(filename)), filename)
+    parent = extend_template(parent, loader, parser, seen + (filename,))
+    _replace_blocks(parent.suite, _template_blocks(root.suite, {}))
+
+    head = [s for s in root.suite.sections
+            if isinstance(s, (VarNode, AssignmentNode, CodeNode, DefNode, StatementNode))]
+    suite = SuiteNode(head + parent.suite.sections)
+    return DefwithNode(root.signature or parent.signature, suite)
+
 class CodeNode:
     def __init__(self, stmt, block, begin_indent=''):
         # compensate one line for $code:
@@ -664,7 +1103,7 @@ class DefNode(BlockNode):
         BlockNode.__init__(self, *a, **kw)
 
         code = CodeNode("", "")
-        code.code = "self = TemplateResult(); extend_ = self.extend\n"
+        code.code = "self = TemplateResult(); extend_ = self.extend; esc_ = escape_\n"
         self.suite.sections.insert(0, code)
 
         code = CodeNode("", "")
@@ -693,7 +1132,18 @@ class SuiteNode:
         self.sections = sections
 
     def emit(self, indent, text_indent=''):
-        return "\n" + "".join([s.emit(indent, text_indent) for s in self.sections])
+        out = []
+        lines = []
+        for s in self.sections + [None]:
+            if isinstance(s, LineNode):
+                lines.append(s)
+                continue
+            if lines:
+                out.append(emit_lines(lines, indent, text_indent))
+                lines = []
+            if s is not None:
+                out.append(s.emit(indent, text_indent))
+        return "\n" + "".join(out)
 
     def __repr__(self):
         return repr(self.sections)
@@ -705,9 +1155,14 @@ STATEMENT_NODES = {
     'elif': ElifNode,
     'else': ElseNode,
     'def': DefNode,
-    'code': CodeNode
+    'code': CodeNode,
+    'cache': CacheNode,
+    'block': TemplateBlockNode
 }
 
+# 这些语句的名字也可以是变量名, 见 Parser.is_statement_at
+NAME_STATEMENTS = ['cache', 'block', 'extends']
+
 KEYWORDS = [
     "pass",
     "break",
@@ -728,7 +1183,7 @@ TEMPLATE_BUILTIN_NAMES = [
 import __builtin__
 TEMPLATE_BUILTINS = dict([(name, getattr(__builtin__, name)) for name in TEMPLATE_BUILTIN_NAMES if name in __builtin__.__dict__])
 
-class ForLoop:
+class ForLoop(object):
     """
     Wrapper for expression in for stament to support loop.xxx helpers.
 
@@ -744,10 +1199,13 @@ class ForLoop:
             ...
         AttributeError: index
     """
+    __slots__ = ('_ctx',)
+
     def __init__(self):
         self._ctx = None
 
     def __getattr__(self, name):
+        # 没有在循环里时, 下面的 property 也会到这里
         if self._ctx is None:
             raise AttributeError, name
         else:
@@ -763,22 +1221,40 @@ class ForLoop:
     def _pop(self):
         self._ctx = self._ctx.parent
 
-class ForLoopContext:
+    # 常用的直接从 context 里取, 不经过 __getattr__
+    index = property(lambda self: self._ctx.index)
+    length = property(lambda self: self._ctx.length)
+    parent = property(lambda self: self._ctx.parent)
+    index0 = property(lambda self: self._ctx.index - 1)
+    first = property(lambda self: self._ctx.index == 1)
+    last = property(lambda self: self._ctx.index == self._ctx.length)
+    odd = property(lambda self: self._ctx.index % 2 == 1)
+    even = property(lambda self: self._ctx.index % 2 == 0)
+    parity = property(lambda self: self._ctx.index % 2 and 'odd' or 'even')
+    revindex0 = property(lambda self: self._ctx.length - self._ctx.index)
+    revindex = property(lambda self: self._ctx.length - self._ctx.index + 1)
+
+class ForLoopContext(object):
     """Stackable context for ForLoop to support nested for loops.
     """
+    __slots__ = ('_forloop', 'parent', 'length', 'index')
+
     def __init__(self, forloop, parent):
         self._forloop = forloop
         self.parent = parent
+        self.length = 0
+        self.index = 0
 
     def setup(self, seq):
         try:
             self.length = len(seq)
-        except:
+        except TypeError:
             self.length = 0
 
-        self.index = 0
+        index = 0
         for a in seq:
-            self.index += 1
+            index += 1
+            self.index = index
             yield a
         self._forloop._pop()
 
@@ -787,11 +1263,437 @@ class ForLoopContext:
     last = property(lambda self: self.index == self.length)
     odd = property(lambda self: self.index % 2 == 1)
     even = property(lambda self: self.index % 2 == 0)
-    parity = property(lambda self: ['odd', 'even'][self.even])
+    parity = property(lambda self: self.index % 2 and 'odd' or 'even')
     revindex0 = property(lambda self: self.length - self.index)
     revindex = property(lambda self: self.length - self.index + 1)
 
+class FragmentCache:
+    r"""Bounded in-process cache for the output of template fragments.
+
+    Used by `$cache key, ttl:` blocks, which render their body only when
+    `key` is not cached or has expired. `ttl` is in seconds, None keeps the
+    fragment until it's invalidated or evicted. At most `size` fragments are
+    kept, the oldest ones are dropped first. Only the output is cached, not
+    the $var attributes set inside the block. The fragments are kept per
+    template, the same key in two templates doesn't share the output.
+
+        >>> cache = FragmentCache()
+        >>> t = Template('$def with (user, x)\n$cache ("nav", user), 60:\n    <nav>$user $x</nav>\n', fragment_cache=cache)
+        >>> r = lambda *a: unicode(t(*a)).strip()
+        >>> r('bob', 1), r('bob', 2), r('tom', 3)
+        (u'<nav>bob 1</nav>', u'<nav>bob 1</nav>', u'<nav>tom 3</nav>')
+        >>> cache.invalidate(('nav', 'bob'))
+        >>> r('bob', 4), r('tom', 5)
+        (u'<nav>bob 4</nav>', u'<nav>tom 3</nav>')
+
+    Invalidating a key also drops the tuple keys starting with it:
+
+        >>> cache.invalidate('nav')
+        >>> r('tom', 6)
+        u'<nav>tom 6</nav>'
+        >>> other = Template('$def with (user)\n$cache ("nav", user), 60:\n    <other>$user</other>\n',
+        ...                  filename='other.html', fragment_cache=cache)
+        >>> unicode(other('tom')).strip()
+        u'<other>tom</other>'
+
+    Whole templates or other functions can be cached with `cached`, the
+    arguments become part of the key:
+
+        sidebar = fragment_cache.cached('sidebar', ttl=60)(render.sidebar)
+    """
+    def __init__(self, size=1000):
+        # (template, key) -> (value, expires)
+        self._entries = LimitedSizeDict(size_limit=size)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, template=None):
+        try:
+            value, expires = self._entries[template, key]
+        except (KeyError, TypeError):
+            return default
+        if expires is not None and expires < time.time():
+            return default
+        return value
+
+    def set(self, key, value, ttl=None, template=None):
+        """Caches `value` as `key`, rendered by the template with filename `template` if any."""
+        expires = ttl is not None and time.time() + ttl or None
+        with self._lock:
+            try:
+                self._entries[template, key] = (value, expires)
+            except TypeError:  # unhashable key
+                pass
+
+    def invalidate(self, key):
+        """Drops `key` and the tuple keys starting with `key` (or with the items of `key` if it is a tuple),
+        in all the templates."""
+        prefix = isinstance(key, tuple) and key or (key,)
+        with self._lock:
+            for template, k in self._entries.keys():
+                if k == key or isinstance(k, tuple) and k[:len(prefix)] == prefix:
+                    del self._entries[template, k]
+
+    def invalidate_template(self, filename):
+        """Drops the fragments rendered by the template `filename`."""
+        with self._lock:
+            for k in self._entries.keys():
+                if k[0] == filename:
+                    del self._entries[k]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def fragment(self, result, key, ttl=None, template=None):
+        """Runs the body of a `$cache` block, which writes to `result`, once if `key` isn't cached."""
+        value = self.get(key, None, template)
+        if value is not None:
+            result.extend([value])
+            return
+
+        parts = result._parts
+        start = len(parts)
+        # 流式输出的时候先不要 flush, 需要从 parts 里取出这一段
+        result.__dict__['_hold'] += 1
+        try:
+            yield key
+        finally:
+            result.__dict__['_hold'] -= 1
+        try:
+            value = u"".join(parts[start:])
+        except TypeError:
+            value = u"".join([safeunicode(p) for p in parts[start:]])
+        self.set(key, value, ttl, template)
+
+    def cached(self, key, ttl=None):
+        """Decorator caching the output of a template or function, keyed by `key` and the arguments."""
+        def decorator(f):
+            def g(*a, **kw):
+                k = (key,) + a + tuple(sorted(kw.items()))
+                value = self.get(k)
+                if value is None:
+                    value = safeunicode(f(*a, **kw))
+                    self.set(k, value, ttl)
+                return value
+            return g
+        return decorator
+
+# 默认所有模版共用一个
+fragment_cache = FragmentCache()
+
+class TemplateProfiler(Profiler):
+    r"""Profiler of template renders: call counts, total and self time and
+    the call tree of the templates, one span per template filename. With
+    `lines=True` it also counts the hits of every template line, mapped
+    back through `__lineoffset__`; that uses sys.settrace and is much
+    slower, and lines inside `$def` functions aren't counted.
+
+    Pass it to Template or Render as `profiler`; templates created without
+    one are not wrapped at all.
+
+        >>> p = TemplateProfiler(lines=True)
+        >>> render = Render(DictLoader({'page.html': '$def with (items)\nhello\n$for i in items:\n    $:render.item(i)\n',
+        ...                             'item.html': '$def with (i)\n<li>$i</li>'}), profiler=p)
+        >>> render._add_global(render, 'render')
+        >>> unicode(render.page([1, 2]))
+        u'hello\n<li>1</li>\n\n<li>2</li>\n\n'
+        >>> s = p.stats()
+        >>> s['page.html']['count'], s['item.html']['count']
+        (1, 2)
+        >>> sorted(line.rsplit(' ', 1)[0] for line in p.collapsed())
+        ['page.html', 'page.html;item.html']
+        >>> sorted(p.line_hits().items())
+        [(('item.html', 2), 2), (('page.html', 2), 1), (('page.html', 3), 3), (('page.html', 4), 2)]
+    """
+    def __init__(self, lines=False, **keywords):
+        Profiler.__init__(self, **keywords)
+        self.lines = lines
+        self._thread_lines = []
+
+    def wrap(self, f, name, nlines=None):
+        """Returns template function `f` timed as span `name`, which has
+        `nlines` lines."""
+        span = self.span
+        if not (self.lines and f.func_code.co_filename == name):
+            def profiled(*a, **kw):
+                __hidetraceback__ = True
+                with span(name):
+                    return f(*a, **kw)
+        else:
+            tracer = self._tracer(name, nlines)
+
+            def profiled(*a, **kw):
+                __hidetraceback__ = True
+                with span(name):
+                    previous = sys.gettrace()
+                    sys.settrace(tracer)
+                    try:
+                        return f(*a, **kw)
+                    finally:
+                        sys.settrace(previous)
+        profiled.__wrapped__ = f
+        return profiled
+
+    def _hits(self):
+        try:
+            return self._local.lines
+        except AttributeError:
+            self._local.lines = {}
+            with self._lock:
+                self._thread_lines.append(self._local.lines)
+            return self._local.lines
+
+    def _tracer(self, filename, nlines):
+        def trace_lines(frame, event, arg):
+            # 跳过函数开头的 __lineoffset__, loop, self 三行和最后的 return self
+            if event == 'line' and frame.f_lineno > frame.f_code.co_firstlineno + 3:
+                offset = frame.f_locals.get('__lineoffset__')
+                lineno = offset is not None and frame.f_lineno + offset
+                if lineno and (nlines is None or lineno <= nlines):
+                    hits = self._hits()
+                    key = (filename, lineno)
+                    hits[key] = hits.get(key, 0) + 1
+            return trace_lines
+
+        def trace(frame, event, arg):
+            # 只跟踪模版自己的代码
+            if frame.f_code.co_filename == filename:
+                return trace_lines
+        return trace
+
+    def line_hits(self):
+        """Hit counts of the template lines: {(filename, lineno): count}."""
+        with self._lock:
+            thread_lines = list(self._thread_lines)
+        merged = {}
+        for hits in thread_lines:
+            for key, n in hits.items():
+                merged[key] = merged.get(key, 0) + n
+        return merged
+
+    def report(self):
+        """The stats of the templates, followed by the most hit lines."""
+        out = Profiler.report(self)
+        hits = self.line_hits()
+        if hits:
+            lines = ['%-40s %8s %10s' % ('template', 'line', 'hits')]
+            for (filename, lineno), n in sorted(hits.items(), key=lambda x: (-x[1], x[0])):
+                lines.append('%-40s %8d %10d' % (filename, lineno, n))
+            out += '\n\n' + '\n'.join(lines)
+        return out
+
+    def clear(self):
+        Profiler.clear(self)
+        with self._lock:
+            for hits in self._thread_lines:
+                hits.clear()
+
+class Markup(unicode):
+    r"""A unicode string which is already escaped for HTML, templates with
+    the html or xml filter output it as it is. Objects with a `__html__`
+    method are not escaped either. The js, json and url filters escape them
+    like any other string, HTML markup isn't safe there.
+
+        >>> t = Template('$def with (a, b)\n$a $b', filename='a.html')
+        >>> unicode(t(u'<b>', Markup(u'<b>')))
+        u'&lt;b&gt; <b>\n'
+        >>> for filter in ['js', 'json', 'url']:
+        ...     print unicode(Template('$def with (x)\n$x', filter=filter)(Markup(u'</script>&b=<c>'))),
+        \u003c/script\u003e\u0026b=\u003cc\u003e
+        \u003c/script\u003e\u0026b=\u003cc\u003e
+        %3C/script%3E%26b%3D%3Cc%3E
+    """
+    __slots__ = ()
+
+    def __html__(self):
+        return self
+
+    def __repr__(self):
+        return 'Markup(%s)' % unicode.__repr__(self)
+
+def _urlquote(text):
+    return safeunicode(urlquote(text))
+
+# 可以用名字指定模版的 filter, 比如 Template(text, filter='js')
+ESCAPE_FILTERS = {
+    'html': websafe,
+    'xml': websafe,
+    'none': None,
+    'json': jsquote,
+    'js': jsquote,
+    'url': _urlquote,
+}
+
+# esc_ 按类型直接转换的值, 转换之后不需要再转义
+_SAFE_CONVERTERS = {
+    type(None): lambda value: u'',
+}
+# 内置的 filter 不会改变数字, 数字也可以直接转换
+_NUMBER_CONVERTERS = dict(_SAFE_CONVERTERS)
+_NUMBER_CONVERTERS.update({int: unicode, long: unicode, float: unicode, bool: unicode})
+# Markup 只在 html 里是安全的, 在 js 和 url 里还要转义
+_HTML_CONVERTERS = dict(_NUMBER_CONVERTERS)
+_HTML_CONVERTERS[Markup] = lambda value: value
+_HTML_FILTERS = (websafe, htmlquote)
+
+class _LimitState(threading.local):
+    # 嵌套的模版共用最外层的 render 的状态
+    active = False
+    iterations = 0
+    deadline = None
+
+class RenderLimits(object):
+    r"""Resource limits of the renders of untrusted templates: at most
+    `max_output` characters of output, `max_iterations` loop iterations and
+    `timeout` seconds per render, None is unlimited. Templates rendered by
+    a template count in the iterations and the time of the outer render.
+    Exceeding a limit raises LimitExceeded.
+
+    Pass it to Template or Render as `limits`. The loops of the template
+    (`$for`, `$while`, comprehensions and the loops of `$code`) are then
+    compiled with a check of the limits; templates without limits are
+    compiled as before, and the template can't rebind the names used for
+    the checks (`guard_`, `tick_`, `range`, ...). The time is only checked
+    in the loops, so a single slow call isn't interrupted, and only `range`
+    is limited in the size of the values it builds (`'x' * n` is not). The
+    output size isn't checked by `stream` and `stream_to`, which write the
+    output out in chunks as it's produced.
+
+        >>> limits = RenderLimits(max_output=20, max_iterations=1000)
+        >>> t = Template('$def with (n)\n$for i in range(n): $i', limits=limits)
+        >>> unicode(t(3))
+        u'0\n1\n2\n'
+        >>> t(20)
+        Traceback (most recent call last):
+            ...
+        LimitExceeded: output of more than 20 characters
+        >>> t(10 ** 6)
+        Traceback (most recent call last):
+            ...
+        LimitExceeded: range of more than 1000 items
+        >>> Template('$code:\n    while True: pass', limits=limits)()
+        Traceback (most recent call last):
+            ...
+        LimitExceeded: more than 1000 loop iterations
+        >>> Template('$for i in xrange(10 ** 9): $i', limits=RenderLimits(timeout=0.01))()
+        Traceback (most recent call last):
+            ...
+        LimitExceeded: render took more than 0.01 seconds
+        >>> Template('$ tick_ = int\n$while True: $pass', limits=limits)
+        Traceback (most recent call last):
+            ...
+        SecurityError: <template>:6 - assignment to reserved name 'tick_' is denied
+        >>> Template('$ guard_ = iter\n$for i in xrange(10): $i', limits=limits)
+        Traceback (most recent call last):
+            ...
+        SecurityError: <template>:6 - assignment to reserved name 'guard_' is denied
+        >>> Template('$code:\n    def range(*a): return []\n    self = 1', limits=limits)
+        Traceback (most recent call last):
+            ...
+        SecurityError: <template>:7 - assignment to reserved name 'range' is denied
+        <template>:8 - assignment to reserved name 'self' is denied
+        >>> Template('$def f(TemplateResult, *extend_):\n    $pass', limits=limits)
+        Traceback (most recent call last):
+            ...
+        SecurityError: <template>:7 - assignment to reserved name 'extend_' is denied
+        <template>:7 - assignment to reserved name 'TemplateResult' is denied
+        >>> [unicode(r) for r in t.render_many([(2,), (20,)])]
+        Traceback (most recent call last):
+            ...
+        LimitExceeded: output of more than 20 characters
+    """
+    def __init__(self, max_output=None, max_iterations=None, timeout=None):
+        self.max_output = max_output
+        self.max_iterations = max_iterations
+        self.timeout = timeout
+        self._state = _LimitState()
+
+    def wrap(self, f):
+        """Returns template function `f` starting a render with the limits,
+        unless it is called by another template."""
+        state = self._state
+        timeout = self.timeout
+
+        def limited(*a, **kw):
+            __hidetraceback__ = True
+            if state.active:
+                return f(*a, **kw)
+            state.active = True
+            state.iterations = 0
+            state.deadline = timeout is not None and time.time() + timeout or None
+            try:
+                return f(*a, **kw)
+            finally:
+                state.active = False
+        limited.__wrapped__ = f
+        return limited
+
+    def tick(self):
+        """Counts a loop iteration, raises LimitExceeded past the limits."""
+        state = self._state
+        state.iterations += 1
+        if self.max_iterations is not None and state.iterations > self.max_iterations:
+            raise LimitExceeded, 'more than %d loop iterations' % self.max_iterations
+        # time.time() 比循环本身还慢, 每 64 次才看一次时间
+        if state.deadline is not None and not state.iterations & 63 and time.time() > state.deadline:
+            raise LimitExceeded, 'render took more than %s seconds' % self.timeout
+
+    def guard(self, iterable):
+        """Yields the items of `iterable`, counting them like `tick`."""
+        # tick 内联在这里, 每次循环少一次函数调用
+        state = self._state
+        max_iterations = self.max_iterations
+        if max_iterations is None:
+            max_iterations = sys.maxint
+        for item in iterable:
+            state.iterations += 1
+            if state.iterations > max_iterations or not state.iterations & 63 and state.deadline is not None:
+                state.iterations -= 1
+                self.tick()
+            yield item
+
+    def range(self, *a):
+        # range 一次就生成整个 list, 不能等循环的时候再检查
+        if self.max_iterations is not None and len(xrange(*a)) > self.max_iterations:
+            raise LimitExceeded, 'range of more than %d items' % self.max_iterations
+        return range(*a)
+
+    def result(self, *a, **kw):
+        """Returns a TemplateResult whose `extend` checks the size of the output."""
+        return self.limit_output(TemplateResult(*a, **kw))
+
+    def limit_output(self, r):
+        """Makes the `extend` of TemplateResult `r` check the size of the output written from now on."""
+        parts_extend = r._parts.extend
+        max_output = self.max_output
+        size = [0]
+
+        def extend(items):
+            parts_extend(items)
+            try:
+                size[0] += len(u"".join(items))
+            except TypeError:
+                # layout 里的页面是 TemplateResult
+                size[0] += sum(map(len, items))
+            if size[0] > max_output:
+                raise LimitExceeded, 'output of more than %d characters' % max_output
+        r.__dict__['extend'] = extend
+        return r
+
+    def env(self, builtins):
+        """The names the template code uses to check the limits."""
+        env = dict(guard_=self.guard, tick_=self.tick)
+        if self.max_output is not None:
+            env['TemplateResult'] = self.result
+        if 'range' in builtins:
+            env['__builtins__'] = dict(builtins, range=self.range)
+        return env
+
 class BaseTemplate:
+    fragment_cache = None
+    profiler = None
+    limits = None
+
     def __init__(self, code, filename, filter, globals, builtins):
         self.filename = filename
         self.filter = filter
@@ -811,20 +1713,152 @@ class BaseTemplate:
         __hidetraceback__ = True
         return self.t(*a, **kw)
 
+    def stream_to(self, write, threshold, a=(), kw={}):
+        """Renders the template, calling `write` with chunks of about
+        `threshold` characters of output as soon as they are produced.
+        Returns the TemplateResult, which keeps the $var attributes.
+        """
+        __hidetraceback__ = True
+        f, env = self._rebind()
+
+        def result(*args, **kwargs):
+            # 只有最外层的输出是流式的, 模版里 $def 定义的函数照常返回结果
+            env['TemplateResult'] = TemplateResult
+            r = TemplateResult(*args, **kwargs)
+            r._stream_to(write, threshold)
+            return r
+        env['TemplateResult'] = result
+
+        r = f(*a, **kw)
+        if isinstance(r, TemplateResult):
+            r._flush()
+        elif r:
+            write(safeunicode(r))
+        return r
+
+    def _rebind(self):
+        """Returns a copy of the template function with its own globals, and the globals."""
+        f = self.t
+        # 开了 profiler 或者 limits 的时候 self.t 是包装过的函数
+        while getattr(f, '__wrapped__', None) is not None:
+            f = f.__wrapped__
+        env = dict(f.func_globals)
+        f = types.FunctionType(f.func_code, env, f.func_name, f.func_defaults, f.func_closure)
+        return self._wrap(f), env
+
+    def _wrap(self, f, nlines=None):
+        """Wraps template function `f` with the profiler and the limits, if any."""
+        if self.profiler is not None:
+            f = self.profiler.wrap(f, self.filename, nlines)
+        if self.limits is not None:
+            f = self.limits.wrap(f)
+        return f
+
+    def _batch_renderer(self):
+        """Returns a function rendering the template with the args (a tuple)
+        or keyword args (a dict) it's called with, to unicode. The output of
+        every call is collected in the same TemplateResult, so it's not
+        thread-safe and the $var attributes are dropped."""
+        __hidetraceback__ = True
+        f, env = self._rebind()
+        # 有 limits 的时候是检查输出大小的 TemplateResult
+        make_result = env['TemplateResult']
+        limits = self.limits
+        limit_output = limits is not None and limits.max_output is not None and limits.limit_output
+        reused = TemplateResult()
+        parts = reused._parts
+        d = reused._d
+
+        def result():
+            # 模版里 $def 定义的函数用新的 TemplateResult
+            env['TemplateResult'] = make_result
+            del parts[:]
+            d.clear()
+            d['__body__'] = u''
+            if limit_output:
+                limit_output(reused)
+            return reused
+
+        def render(context):
+            __hidetraceback__ = True
+            env['TemplateResult'] = result
+            if isinstance(context, dict):
+                f(**context)
+            else:
+                f(*context)
+            try:
+                return u"".join(parts)
+            except TypeError:
+                return u"".join([safeunicode(p) for p in parts])
+        return render
+
     def make_env(self, globals, builtins):
-        return dict(globals,
+        fragment = (self.fragment_cache or fragment_cache).fragment
+        filename = self.filename
+        env = dict(globals,
             __builtins__=builtins,
             ForLoop=ForLoop,
             TemplateResult=TemplateResult,
-            escape_=self._escape,
-            join_=self._join
+            escape_=self._make_escape(),
+            join_=self._join,
+            # 片段记录是哪个模版的, 模版修改后可以只删除它的片段
+            cache_=lambda result, key, ttl=None: fragment(result, key, ttl, filename)
         )
+        if self.limits is not None:
+            env.update(self.limits.env(builtins))
+        return env
     def _join(self, *items):
         return u"".join(items)
 
+    def _make_escape(self):
+        r"""Returns the escape function of the template, specialised for its
+        filter: unicode, numbers, None and Markup are handled without going
+        through safeunicode.
+
+            >>> unicode(Template('$def with (s, n)\nvar s = "$s", n = $n;', filter='js')(u'</script>"', 1.5))
+            u'var s = "\\u003c/script\\u003e\\"", n = 1.5;\n'
+        """
+        filter = self.filter
+        if filter in _HTML_FILTERS:
+            converters = _HTML_CONVERTERS
+        elif filter in ESCAPE_FILTERS.values():
+            converters = _NUMBER_CONVERTERS
+        else:
+            converters = _SAFE_CONVERTERS
+        if filter is websafe:
+            # 快速路径上的值已经是 unicode 了
+            filter = htmlquote
+        get_converter = converters.get
+        escape_slow = self._escape
+
+        def escape_(value, escape=False):
+            cls = value.__class__
+            if cls is unicode:
+                # 最常见的情况, 不需要再转换
+                if escape and filter:
+                    return filter(value)
+                return value
+            convert = get_converter(cls)
+            if convert is not None:
+                return convert(value)
+            return escape_slow(value, escape)
+        return escape_
+
     def _escape(self, value, escape=False):
+        if value.__class__ is unicode:
+            # 最常见的情况, 不需要再转换
+            if escape and self.filter:
+                return self.filter(value)
+            return value
         if value is None:
             value = ''
+        elif value.__class__ is TemplateResult:
+            if value._spool is not None and not escape:
+                # 流式渲染的 layout 里的 $:page, 输出的时候再从 spool 里读出来
+                return value
+        elif escape and self.filter in _HTML_FILTERS and hasattr(value, '__html__'):
+            # 已经转义过的 html
+            return safeunicode(value.__html__())
 
         value = safeunicode(value)
         if escape and self.filter:
@@ -843,14 +1877,42 @@ class Template(BaseTemplate):
         '.xml': websafe
     }
     globals = {}
-
-    def __init__(self, text, filename='<template>', filter=None, globals=None, builtins=None, extensions=None):
+    bytecode_cache = None
+    # stream 时每次输出的大概字符数
+    stream_threshold = 8192
+    # stream 时 layout 的页面先写到 spool 里, 超过这个大小写到磁盘
+    spool_size = 1024 * 1024
+
+    def __init__(self, text, filename='<template>', filter=None, globals=None, builtins=None, extensions=None,
+                 bytecode_cache=None, stream_threshold=None, fragment_cache=None, loader=None, code=None,
+                 profiler=None, limits=None):
         self.extensions = extensions or []
+        # 用来找 $extends 的模版
+        self.loader = loader
+        # $extends 的模版的文件名, 从近到远
+        self.extends = []
+        if bytecode_cache is not None:
+            self.bytecode_cache = bytecode_cache
+        if fragment_cache is not None:
+            self.fragment_cache = fragment_cache
+        if stream_threshold is not None:
+            self.stream_threshold = stream_threshold
+        if profiler is not None:
+            self.profiler = profiler
+        if limits is not None:
+            self.limits = limits
         text = Template.normalize_text(text)
-        code = self.compile_template(text, filename)
+        if code is None:
+            code = self.load_code(text, filename)
+        else:
+            # 已经编译好的代码, 比如 Render.preload 在其他进程里编译的
+            self.extends = [f for f, _ in self.find_extends(text)]
 
         _, ext = os.path.splitext(filename)
-        filter = filter or self.FILTERS.get(ext, None)
+        if isinstance(filter, basestring):
+            filter = ESCAPE_FILTERS[filter]
+        else:
+            filter = filter or self.FILTERS.get(ext, None)
         self.content_type = self.CONTENT_TYPES.get(ext, None)
 
         if globals is None:
@@ -859,6 +1921,103 @@ class Template(BaseTemplate):
             builtins = TEMPLATE_BUILTINS
 
         BaseTemplate.__init__(self, code=code, filename=filename, filter=filter, globals=globals, builtins=builtins)
+        self.t = self._wrap(self.t, text.count('\n'))
+
+    def stream(self, *a, **kw):
+        r"""Renders the template in a background thread, yielding the output
+        in chunks of about `stream_threshold` characters while it runs, so
+        that large outputs are never kept in memory as a whole.
+
+            >>> t = Template('$def with (n)\n$for i in range(n): $i,', stream_threshold=8)
+            >>> list(t.stream(6))
+            [u'0,\n1,\n2,\n', u'3,\n4,\n5,\n']
+        """
+        return iter_stream(lambda write: self.stream_to(write, self.stream_threshold, a, kw))
+
+    def render_to(self, fileobj, encoding='utf-8', a=(), kw={}):
+        r"""Renders the template into the file object `fileobj`, or into the
+        file at path `fileobj`. The output fragments are joined, encoded and
+        written in batches, so the whole output is never joined and encoded
+        as one string. For a socket, pass `sock.makefile('wb')`. Returns the
+        TemplateResult, which keeps the $var attributes.
+
+            >>> import StringIO
+            >>> f = StringIO.StringIO()
+            >>> t = Template('$def with (s)\n$var title: $s\n$for i in range(3): $s$i', stream_threshold=4)
+            >>> r = t.render_to(f, 'utf-8', (u'\xe9',))
+            >>> f.getvalue(), r.title
+            ('\xc3\xa90\n\xc3\xa91\n\xc3\xa92\n', u'\xe9')
+        """
+        __hidetraceback__ = True
+        if isinstance(fileobj, basestring):
+            f = open(fileobj, 'wb')
+            try:
+                return self.render_to(f, encoding, a, kw)
+            finally:
+                f.close()
+        r = self(*a, **kw)
+        if isinstance(r, TemplateResult):
+            r._write_to(fileobj.write, encoding)
+        elif r:
+            fileobj.write(safestr(r, encoding))
+        return r
+
+    def render_many(self, contexts, workers=None, processes=False, chunksize=64):
+        r"""Renders the template once for every item of `contexts`, a dict
+        of keyword arguments or a tuple of arguments, and yields the outputs
+        as unicode strings, in order. The $var attributes are not kept.
+
+        The render state is set up once per worker instead of once per
+        item. With `workers` the items are rendered by a pool of threads,
+        with `processes=True` by a pool of forked processes (`workers` of
+        them, the number of cpus by default), which is what CPU-bound
+        templates need; the items and outputs must then be picklable. Items
+        are sent to the pool `chunksize` at a time. The pool is started by
+        the first next() and stopped when the items run out or the iterator
+        is closed.
+
+            >>> t = Template('$def with (name, n=1)\n$for i in range(n): Hi $name.')
+            >>> list(t.render_many([dict(name='a'), ('b', 2)]))
+            [u'Hi a.\n', u'Hi b.\nHi b.\n']
+            >>> list(t.render_many((dict(name=i) for i in range(3)), workers=2, processes=True))
+            [u'Hi 0.\n', u'Hi 1.\n', u'Hi 2.\n']
+            >>> import multiprocessing
+            >>> it = t.render_many([dict(name='a')], workers=2, processes=True)
+            >>> multiprocessing.active_children()
+            []
+            >>> it.next()
+            u'Hi a.\n'
+            >>> it.close()
+        """
+        if processes:
+            import multiprocessing
+            make_pool = lambda: multiprocessing.Pool(workers, _render_many_init, (self,))
+            return _imap_pool(make_pool, _render_many_call, contexts, chunksize)
+        elif workers and workers > 1:
+            from multiprocessing.pool import ThreadPool
+            local = threading.local()
+
+            def render(context):
+                try:
+                    f = local.render
+                except AttributeError:
+                    f = local.render = self._batch_renderer()
+                return f(context)
+            return _imap_pool(lambda: ThreadPool(workers), render, contexts, chunksize)
+        else:
+            return itertools.imap(self._batch_renderer(), contexts)
+
+    def spool(self, *a, **kw):
+        """Renders the template into a temporary file instead of memory.
+        The result can be passed as page to a layout rendered with `stream`.
+        """
+        __hidetraceback__ = True
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        r = self.stream_to(lambda chunk: f.write(chunk.encode('utf-8')), self.stream_threshold, a, kw)
+        if not isinstance(r, TemplateResult):
+            r = TemplateResult()
+        r.__dict__['_spool'] = f
+        return r
 
     def normalize_text(text):
         """Normalizes template text by correcting \r\n, tabs and BOM chars."""
@@ -881,10 +2040,11 @@ class Template(BaseTemplate):
 
         return BaseTemplate.__call__(self, *a, **kw)
 
-    def generate_code(text, filename, parser=None):
+    def generate_code(text, filename, parser=None, loader=None):
         # parse the text
         parser = parser or Parser()
         rootnode = parser.parse(text, filename)
+        rootnode = extend_template(rootnode, loader, parser)
 
         # generate python code from the parse tree
         code = rootnode.emit(indent="").strip()
@@ -898,9 +2058,35 @@ class Template(BaseTemplate):
             p = ext(p)
         return p
 
+    def find_extends(self, text):
+        """Returns the (filename, text) of the templates extended by `text`, from the nearest."""
+        return find_extends(text, self.loader)
+
+    def load_code(self, text, filename):
+        """Returns the compiled code of the template, from the bytecode cache if possible."""
+        parents = self.find_extends(text)
+        self.extends = [f for f, _ in parents]
+        cache = self.bytecode_cache
+        if not cache:
+            return self.compile_template(text, filename)
+
+        # 父模版修改了也要重新编译, 有 limits 的模版的循环是检查过的, 不能和其他的共用
+        extensions = self.extensions + (self.limits is not None and [LoopGuard] or [])
+        key = cache.get_key(filename, ''.join([text] + [t for _, t in parents]), extensions)
+        code = cache.load(key)
+        if code is None:
+            code = self.compile_template(text, filename)
+            if code is not None:
+                cache.dump(key, code)
+        return code
+
     def compile_template(self, template_string, filename):
-        code = Template.generate_code(template_string, filename, parser=self.create_parser())
+        code = Template.generate_code(template_string, filename, parser=self.create_parser(), loader=self.loader)
+        return Template.compile_code(code, filename, guard=self.limits is not None)
 
+    def compile_code(code, filename, guard=False):
+        """Compiles the generated python code and makes sure that it is safe.
+        With `guard` the loops check the RenderLimits of the template."""
         def get_source_line(filename, lineno):
             try:
                 lines = open(filename).read().splitlines()
@@ -908,35 +2094,133 @@ class Template(BaseTemplate):
             except:
                 return None
 
-        try:
-            # compile the code first to report the errors, if any, with the filename
-            compiled_code = compile(code, filename, 'exec')
-        except SyntaxError, e:
+        def add_traceback(e):
             # display template line that caused the error along with the traceback.
             try:
                 e.msg += '\n\nTemplate traceback:\n    File %s, line %s\n        %s' % \
                     (repr(e.filename), e.lineno, get_source_line(e.filename, e.lineno-1))
             except:
                 pass
+
+        # parse only once: the same tree is checked for safety and then compiled
+        try:
+            tree = ast.parse(code, filename)
+        except SyntaxError, e:
+            add_traceback(e)
+            raise
+
+        SafeVisitor(guard and RESERVED_NAMES or ()).walk(tree, filename)
+        if guard:
+            tree = ast.fix_missing_locations(LoopGuard().visit(tree))
+
+        try:
+            return compile(tree, filename, 'exec')
+        except SyntaxError, e:
+            # 'return' outside function etc. are only found when compiling the tree
+            add_traceback(e)
             raise
 
-        # make sure code is safe - but not with jython, it doesn't have a working compiler module
-        if not sys.platform.startswith('java'):
+    compile_code = staticmethod(compile_code)
+
+class StreamClosed(Exception):
+    pass
+
+def iter_stream(render, maxsize=2):
+    """Runs `render(write)` in a background thread and yields the chunks
+    passed to `write`. At most `maxsize` chunks are buffered; the thread is
+    stopped when the generator is closed.
+    """
+    queue = Queue.Queue(maxsize=maxsize)
+    closed = []
+
+    def put(item):
+        while not closed:
             try:
-                import compiler
-                ast = compiler.parse(code)
-                SafeVisitor().walk(ast, filename)
-            except ImportError:
-                warnings.warn("Unabled to import compiler module. Unable to check templates for safety.")
-        else:
-            warnings.warn("SECURITY ISSUE: You are using Jython, which does not support checking templates for safety. Your templates can execute arbitrary code.")
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+        raise StreamClosed()
 
-        return compiled_code
+    def write(chunk):
+        if chunk:
+            put((chunk, None))
+
+    def run():
+        try:
+            render(write)
+            item = (None, None)
+        except StreamClosed:
+            return
+        except:
+            item = (None, sys.exc_info())
+        try:
+            put(item)
+        except StreamClosed:
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk, exc_info = queue.get()
+            if chunk is None:
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield chunk
+    finally:
+        closed.append(True)
+
+def find_extends(text, loader):
+    """Returns the (filename, text) of the templates extended by `text`,
+    from the nearest, found with `loader`."""
+    parents = []
+    while loader is not None and '$extends' in text:
+        match = re_extends.search(text)
+        try:
+            name = match and ast.literal_eval(match.group(1))
+        except (SyntaxError, ValueError):
+            break
+        filename = isinstance(name, basestring) and loader.find(name)
+        if not filename or filename in [f for f, _ in parents]:
+            break
+        text = loader.load(filename)
+        parents.append((filename, text))
+    return parents
+
+def _imap_pool(make_pool, func, iterable, chunksize):
+    """Yields func(item) for the items of `iterable`, computed by the pool
+    returned by `make_pool`, which is terminated at the end."""
+    # pool 在第一次迭代时才创建, 没有被迭代的 generator 不会留下 pool
+    pool = make_pool()
+    try:
+        for r in pool.imap(func, iterable, chunksize):
+            yield r
+    finally:
+        pool.terminate()
+
+# Template.render_many 的子进程里用的 renderer
+_render_many_state = None
+
+def _render_many_init(template):
+    global _render_many_state
+    _render_many_state = template._batch_renderer()
+
+def _render_many_call(context):
+    return _render_many_state(context)
 
 class CompiledTemplate(Template):
-    def __init__(self, f, filename):
-        Template.__init__(self, '', filename)
-        self.t = f
+    """Template created from a function precompiled by `compile_templates`."""
+    bytecode_cache = None
+
+    def __init__(self, f, filename, **keywords):
+        Template.__init__(self, '', filename, **keywords)
+        # 模版函数使用自己的 env, 同一个模块里的模版的 filter 可能不同
+        env = self.make_env(self._globals or {}, self._builtins)
+        self.t = types.FunctionType(f.func_code, env, f.func_name, f.func_defaults, f.func_closure)
+        self.t = self._wrap(self.t)
 
     def compile_template(self, *a):
         return None
@@ -944,6 +2228,561 @@ class CompiledTemplate(Template):
     def _compile(self, *a):
         return None
 
+class BytecodeCache:
+    r"""Stores the compiled code of templates as marshal files in `directory`.
+
+    Entries are keyed by the template filename, its text, the extensions and
+    the engine version, so a changed template or a new release simply misses
+    the cache. Warm starts skip parsing, the safety check and compile.
+
+        >>> import tempfile
+        >>> cache = BytecodeCache(tempfile.mkdtemp())
+        >>> unicode(Template('$def with (x)\n$x', bytecode_cache=cache)(1))
+        u'1\n'
+        >>> len(os.listdir(cache.directory))
+        1
+        >>> class NoCompile(Template):
+        ...     def compile_template(self, text, filename): raise AssertionError('compiled')
+        >>> unicode(NoCompile('$def with (x)\n$x', bytecode_cache=cache)(2))
+        u'2\n'
+
+    It can also be set for all templates with `Template.bytecode_cache = BytecodeCache(path)`
+    or passed to `render` and `frender` as the `bytecode_cache` keyword.
+    """
+    suffix = '.tplc'
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def get_key(self, filename, text, extensions=()):
+        # 扩展会改变解析的结果, 也要算在 key 里
+        names = ['%s.%s' % (getattr(ext, '__module__', ''), getattr(ext, '__name__', repr(ext)))
+                 for ext in extensions]
+        h = hashlib.sha1()
+        for part in [ENGINE_VERSION, imp.get_magic(), safestr(filename), ','.join(names), safestr(text)]:
+            h.update(part)
+            h.update('\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, key):
+        """Returns the code object stored under `key` or None."""
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                # 文件损坏, 当作没有缓存
+                return None
+        finally:
+            f.close()
+
+    def dump(self, key, code):
+        """Stores `code` under `key`, writing to a temp file and renaming it,
+        so that concurrent readers never see a partial file."""
+        path = self._path(key)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), id(code))
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump(code, f)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # 缓存目录不可写时不影响渲染
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+class TemplateCache:
+    r"""Thread-safe cache of the templates loaded by a Render.
+
+    At most `size` templates are kept, the oldest ones are dropped first.
+    With `check_interval` set, a cached template is revalidated by stat at
+    most once per `check_interval` seconds and reloaded when its file
+    changed; with None (the default) it is never revalidated. Concurrent
+    first loads of the same template are compiled only once.
+
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> def write(text, mtime):
+        ...     path = os.path.join(root, 'hello.html')
+        ...     open(path, 'w').write(text)
+        ...     os.utime(path, (mtime, mtime))
+        >>> write('$def with (name)\nHello $name', 1000)
+        >>> render = Render(root, cache=True, check_interval=0)
+        >>> unicode(render.hello('world'))
+        u'Hello world\n'
+        >>> write('$def with (name)\nBye $name', 2000)
+        >>> unicode(render.hello('world'))
+        u'Bye world\n'
+    """
+    def __init__(self, size=None, check_interval=None, mtime=None):
+        self.check_interval = check_interval
+        # name -> [template, kind, paths, mtimes, checked_at], paths 包括 $extends 的模版
+        self._entries = LimitedSizeDict(size_limit=size)
+        self._lock = threading.Lock()
+        self._loading = {}
+        if mtime is not None:
+            self._mtime = mtime
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _fresh(self, entry):
+        if self.check_interval is None or not entry[2]:
+            return True
+        now = time.time()
+        if now - entry[4] < self.check_interval:
+            return True
+        if [self._mtime(path) for path in entry[2]] != entry[3]:
+            return False
+        entry[4] = now
+        return True
+
+    def get(self, name, lookup, load):
+        """Returns the template `name`, calling `lookup(name)` to find its
+        (kind, path) and `load(kind, path, name)` to load it when it isn't
+        cached or has changed."""
+        entry = self._entries.get(name)
+        if entry is not None and self._fresh(entry):
+            return entry[0]
+
+        with self._lock:
+            lock = self._loading.get(name)
+            if lock is None:
+                lock = self._loading[name] = threading.Lock()
+
+        with lock:
+            # 其他线程可能已经加载过了
+            entry = self._entries.get(name)
+            if entry is not None and self._fresh(entry):
+                return entry[0]
+
+            kind, path = lookup(name)
+            # 目录对应的子 Render 自己检查, 这里只检查文件
+            paths = kind == 'file' and [path] or []
+            mtimes = [self._mtime(p) for p in paths]
+            t = load(kind, path, name)
+            extends = getattr(t, 'extends', [])
+            paths.extend(extends)
+            mtimes.extend([self._mtime(p) for p in extends])
+            with self._lock:
+                self._entries[name] = [t, kind, paths, mtimes, time.time()]
+            return t
+
+    def invalidate(self, paths):
+        """Drops the templates loaded from any of the files `paths`,
+        including the ones extending them, also in the cached sub-Renders."""
+        paths = set(paths)
+        with self._lock:
+            entries = self._entries.items()
+        for name, entry in entries:
+            if entry[1] == 'dir':
+                cache = getattr(entry[0], '_cache', None)
+                if cache is not None:
+                    cache.invalidate(paths)
+            elif paths.intersection(entry[2]):
+                with self._lock:
+                    if self._entries.get(name) is entry:
+                        del self._entries[name]
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class DependencyGraph:
+    r"""Records which templates use which, by filename. The kind of a use is
+    'extends' for `$extends`, 'render' for a template called through a
+    Render from inside another template and 'base' for the base layout of
+    a Render.
+
+        >>> g = DependencyGraph()
+        >>> g.add('page.html', 'layout.html', 'extends')
+        >>> g.add('page.html', 'nav.html', 'render')
+        >>> g.add('nav.html', 'icon.html', 'render')
+        >>> g.uses('page.html')
+        {'layout.html': 'extends', 'nav.html': 'render'}
+        >>> sorted(g.dependents('icon.html')), sorted(g.dependents('icon.html', kinds=('extends',)))
+        (['nav.html', 'page.html'], [])
+    """
+    def __init__(self):
+        # filename -> {使用的模版的 filename: kind}
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def add(self, user, used, kind):
+        uses = self._uses.get(user)
+        if uses is None or uses.get(used) != kind:
+            with self._lock:
+                self._uses.setdefault(user, {})[used] = kind
+
+    def uses(self, filename):
+        """Returns {filename: kind} of the templates used by `filename`."""
+        return dict(self._uses.get(filename, {}))
+
+    def dependents(self, filename, kinds=None):
+        """Returns the filenames of the templates using `filename`, directly
+        or not, through uses of `kinds` (all kinds by default)."""
+        with self._lock:
+            items = [(user, uses.items()) for user, uses in self._uses.items()]
+        users = {}
+        for user, uses in items:
+            for used, kind in uses:
+                if kinds is None or kind in kinds:
+                    users.setdefault(used, []).append(user)
+
+        found = set()
+        stack = [filename]
+        while stack:
+            for user in users.get(stack.pop(), ()):
+                if user not in found:
+                    found.add(user)
+                    stack.append(user)
+        found.discard(filename)
+        return found
+
+class Loader:
+    """Base class of the template loaders used by Render.
+
+    A template is found by its name, the slash separated path relative to
+    the root of the loader without the extension, e.g. 'mail/welcome' for
+    'mail/welcome.html'. `find` returns the filename of the template, which
+    is passed to `load` and `mtime` and used as the filename of the Template
+    (its extension selects the filter).
+
+    Subclasses implement `_paths`, returning the relative paths of all the
+    files (and of the directories, ending with '/'), `_filename` and `load`.
+    The index of the names is built once, on first use.
+    """
+    def __init__(self):
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _paths(self):
+        raise NotImplementedError
+
+    def _filename(self, path):
+        """Returns the filename of the file at relative `path`."""
+        return path
+
+    def load(self, filename):
+        """Returns the text of the template `filename`."""
+        raise NotImplementedError
+
+    def mtime(self, filename):
+        """Returns the modification time of `filename`, None if it doesn't change."""
+        return None
+
+    def _build_index(self):
+        # 和原来的 glob(name + '.*') 一样, a.b.html 可以用 a 或者 a.b 找到, 有多个匹配的时候取排序后的第一个
+        files = {}
+        dirs = set([''])
+        names = set()
+        for path in sorted(self._paths()):
+            dirname, _, basename = path.rstrip('/').rpartition('/')
+            parts = dirname and dirname.split('/') or []
+            for i in range(len(parts)):
+                dirs.add('/'.join(parts[:i + 1]))
+            if path.endswith('/'):
+                dirs.add(path.rstrip('/'))
+                continue
+            if basename.startswith('.') or basename.endswith('~'): # skip backup files
+                continue
+            prefix = dirname and dirname + '/' or ''
+            pieces = basename.split('.')
+            for i in range(1, len(pieces)):
+                files.setdefault(prefix + '.'.join(pieces[:i]), path)
+            if len(pieces) > 1:
+                names.add(prefix + pieces[0])
+        return files, dirs, sorted(names)
+
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._build_index()
+                index = self._index
+        return index
+
+    def refresh(self):
+        """Rebuilds the index, to pick up added or removed templates."""
+        self._index = None
+
+    def find(self, name):
+        path = self._get_index()[0].get(name)
+        return path and self._filename(path)
+
+    def isdir(self, name):
+        return name in self._get_index()[1]
+
+    def list(self):
+        """Returns the names of all the templates."""
+        return self._get_index()[2]
+
+    def sub(self, name):
+        """Returns a loader for the templates under directory `name`."""
+        return SubLoader(self, name)
+
+class SubLoader(Loader):
+    """Templates under the directory `prefix` of another loader."""
+    def __init__(self, loader, prefix):
+        self.loader = loader
+        self.prefix = prefix + '/'
+
+    def find(self, name):
+        return self.loader.find(self.prefix + name)
+
+    def isdir(self, name):
+        return self.loader.isdir(self.prefix + name)
+
+    def load(self, filename):
+        return self.loader.load(filename)
+
+    def mtime(self, filename):
+        return self.loader.mtime(filename)
+
+    def refresh(self):
+        self.loader.refresh()
+
+    def list(self):
+        n = len(self.prefix)
+        return [name[n:] for name in self.loader.list() if name.startswith(self.prefix)]
+
+    def sub(self, name):
+        return SubLoader(self.loader, self.prefix + name)
+
+class DirectoryLoader(Loader):
+    """Loads the templates from directory `root`.
+
+    The names of the templates are indexed by walking the directory once,
+    instead of a glob on every lookup. When a template isn't found the index
+    is rebuilt, at most once per `rescan_interval` seconds; with None it's
+    never rebuilt, call `refresh` after adding templates. A found file which
+    no longer exists (renamed or deleted) always rebuilds the index.
+
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> open(os.path.join(root, 'page.html'), 'w').write('hi')
+        >>> loader = DirectoryLoader(root)
+        >>> os.path.basename(loader.find('page'))
+        'page.html'
+        >>> os.rename(os.path.join(root, 'page.html'), os.path.join(root, 'page.txt'))
+        >>> os.path.basename(loader.find('page'))
+        'page.txt'
+    """
+    def __init__(self, root, rescan_interval=2.0):
+        Loader.__init__(self)
+        self.root = root
+        self.rescan_interval = rescan_interval
+        self._indexed_at = 0
+
+    def _paths(self):
+        self._indexed_at = time.time()
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            prefix = rel != '.' and rel + '/' or ''
+            paths.extend(prefix + d + '/' for d in dirnames)
+            paths.extend(prefix + f for f in filenames)
+        return paths
+
+    def _filename(self, path):
+        return os.path.join(self.root, *path.split('/'))
+
+    def find(self, name):
+        filename = Loader.find(self, name)
+        if filename is None and self.rescan_interval is not None \
+                and time.time() - self._indexed_at >= self.rescan_interval:
+            self.refresh()
+            filename = Loader.find(self, name)
+        elif filename is not None and not os.path.exists(filename):
+            # 文件被改名或者删除了, 索引已经过期
+            self.refresh()
+            filename = Loader.find(self, name)
+        return filename
+
+    def load(self, filename):
+        f = open(filename)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+class DictLoader(Loader):
+    r"""Loads the templates from a dict of relative filenames to texts.
+
+        >>> render = Render(DictLoader({'hello.html': '$def with (name)\nHello $name', 'mail/bye.txt': 'Bye'}))
+        >>> unicode(render.hello('<b>')), unicode(render.mail.bye())
+        (u'Hello &lt;b&gt;\n', u'Bye\n')
+    """
+    def __init__(self, mapping):
+        Loader.__init__(self)
+        self.mapping = mapping
+
+    def _paths(self):
+        return self.mapping.keys()
+
+    def load(self, filename):
+        return self.mapping[filename]
+
+class ZipLoader(Loader):
+    r"""Loads the templates from the zip archive `path`, or from directory
+    `root` inside it. The archive is reopened when it's replaced.
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'templates.zip')
+        >>> z = zipfile.ZipFile(path, 'w')
+        >>> z.writestr('templates/hello.html', '$def with (name)\nHello $name')
+        >>> z.close()
+        >>> render = Render(ZipLoader(path, 'templates'))
+        >>> unicode(render.hello('<b>'))
+        u'Hello &lt;b&gt;\n'
+    """
+    def __init__(self, path, root=''):
+        Loader.__init__(self)
+        self.path = path
+        self.root = root.strip('/') and root.strip('/') + '/'
+        self._zip = None
+        self._zip_mtime = None
+        self._zip_pid = None
+        self._zip_lock = threading.Lock()
+
+    def _open(self):
+        # ZipFile 不是线程安全的, 调用的时候需要持有 self._zip_lock
+        mtime = os.stat(self.path).st_mtime
+        if self._zip_pid != os.getpid():
+            # fork 出来的子进程和父进程共享文件的读写位置, 子进程里重新打开
+            self._zip = None
+        elif self._zip is not None and mtime != self._zip_mtime:
+            self._zip.close()
+            self._zip = None
+            self.refresh()
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.path)
+            self._zip_mtime = mtime
+            self._zip_pid = os.getpid()
+        return self._zip
+
+    def _paths(self):
+        with self._zip_lock:
+            names = self._open().namelist()
+        n = len(self.root)
+        return [name[n:] for name in names if name.startswith(self.root) and name != self.root]
+
+    def _filename(self, path):
+        return os.path.join(self.path, self.root + path)
+
+    def load(self, filename):
+        member = filename[len(self.path) + 1:].replace(os.sep, '/')
+        with self._zip_lock:
+            return self._open().read(member)
+
+    def mtime(self, filename):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+class ChainLoader(Loader):
+    """Looks for the templates in each of `loaders` in order, like a search path."""
+    def __init__(self, loaders):
+        self.loaders = loaders
+        # filename -> 找到它的 loader
+        self._owners = {}
+
+    def find(self, name):
+        for loader in self.loaders:
+            filename = loader.find(name)
+            if filename is not None:
+                self._owners[filename] = loader
+                return filename
+
+    def isdir(self, name):
+        return any(loader.isdir(name) for loader in self.loaders)
+
+    def load(self, filename):
+        loader = self._owners.get(filename)
+        if loader is not None:
+            return loader.load(filename)
+        # 其他 loader 找到的文件, 比如子目录里的模版
+        for loader in self.loaders:
+            try:
+                return loader.load(filename)
+            except (IOError, KeyError):
+                pass
+        raise IOError('No template file %s' % filename)
+
+    def mtime(self, filename):
+        loader = self._owners.get(filename)
+        if loader is not None:
+            return loader.mtime(filename)
+        for loader in self.loaders:
+            mtime = loader.mtime(filename)
+            if mtime is not None:
+                return mtime
+
+    def refresh(self):
+        for loader in self.loaders:
+            loader.refresh()
+
+    def list(self):
+        names = set()
+        for loader in self.loaders:
+            names.update(loader.list())
+        return sorted(names)
+
+    def sub(self, name):
+        return ChainLoader([loader.sub(name) for loader in self.loaders if loader.isdir(name)])
+
+def make_loader(loc):
+    """Returns the loader for `loc`, which is a loader, a directory, a zip
+    file or a list of them."""
+    if isinstance(loc, Loader):
+        return loc
+    elif isinstance(loc, (list, tuple)):
+        return ChainLoader([make_loader(l) for l in loc])
+    elif os.path.isfile(loc) and zipfile.is_zipfile(loc):
+        return ZipLoader(loc)
+    else:
+        return DirectoryLoader(loc)
+
 class Render:
     """The most preferred way of using templates.
 
@@ -954,19 +2793,59 @@ class Render:
     every template through the base template.
 
         render = web.template.render('templates', base='layout')
+
+    Templates can also extend a layout with `$extends 'layout'`, replacing
+    its `$block name:` sections; that is resolved at compile time, so the
+    page is rendered in a single pass.
+
+    With `cache=True` the compiled templates are kept in a TemplateCache,
+    bounded by `cache_size`, and revalidated every `check_interval` seconds
+    when it is given.
+
+        render = web.template.render('templates', cache=True, check_interval=2)
+
+    `loc` is a directory, a zip file, a Loader or a list of them, searched
+    in order.
+
+        render = web.template.render(['themes/dark', 'templates'])
+
+    Pass a TemplateProfiler as `profiler` to time the templates.
+
+        render = web.template.render('templates', profiler=TemplateProfiler())
+
+    The templates used by each template are recorded in `render._graph`, a
+    DependencyGraph shared with the sub-Renders; `invalidate` uses it to
+    drop only what depends on a changed file.
     """
-    def __init__(self, loc='templates', cache=None, base=None, **keywords):
+    def __init__(self, loc='templates', cache=None, base=None, check_interval=None, cache_size=None, **keywords):
         self._loc = loc
+        self._loader = make_loader(loc)
+        # $extends 的模版名是相对于最上层的 Render 的
+        self._root_loader = self._loader
         self._keywords = keywords
+        self._check_interval = check_interval
+        self._cache_size = cache_size
+
+        # 子目录的 Render 共用最上层的依赖关系和文件的修改时间
+        self._root = self
+        self._graph = DependencyGraph()
+        self._mtimes = {}
+        self._checked_at = time.time()
 
         if cache:
-            self._cache = {}
+            self._cache = TemplateCache(size=cache_size, check_interval=check_interval, mtime=self._loader.mtime)
         else:
             self._cache = None
 
         if base and not hasattr(base, '__call__'):
             # make base a function, so that it can be passed to sub-renders
-            self._base = lambda page: self._template(base)(page)
+            def base_template(page):
+                return self._template(base)(page)
+            # stream 的时候需要 base 模版本身
+            base_template.template = lambda: self._template(base)
+            # 记录依赖只需要文件名, 不用编译 base 模版
+            base_template.find = lambda: self._loader.find(base)
+            self._base = base_template
         else:
             self._base = base
 
@@ -978,11 +2857,10 @@ class Render:
         self._keywords['globals'][name] = obj
 
     def _lookup(self, name):
-        path = os.path.join(self._loc, name)
-        if os.path.isdir(path):
-            return 'dir', path
+        if self._loader.isdir(name):
+            return 'dir', self._loader.sub(name)
         else:
-            path = self._findfile(path)
+            path = self._loader.find(name)
             if path:
                 return 'file', path
             else:
@@ -990,84 +2868,428 @@ class Render:
 
     def _load_template(self, name):
         kind, path = self._lookup(name)
+        return self._load(kind, path, name)
 
+    def _load(self, kind, path, name):
         if kind == 'dir':
-            return Render(path, cache=self._cache is not None, base=self._base, **self._keywords)
+            render = Render(path, cache=self._cache is not None, base=self._base,
+                            check_interval=self._check_interval, cache_size=self._cache_size, **self._keywords)
+            render._root_loader = self._root_loader
+            render._root = self._root
+            render._graph = self._graph
+            return render
         elif kind == 'file':
-            return Template(open(path).read(), filename=path, **self._keywords)
+            t = Template(self._loader.load(path), filename=path, loader=self._root_loader, **self._keywords)
+            self._loaded(t)
+            return t
         else:
             raise AttributeError, "No template named " + name
 
-    def _findfile(self, path_prefix):
-        # 需要模版有后缀名
-        p = [f for f in glob.glob(path_prefix + '.*') if not f.endswith('~')] # skip backup files
-        p.sort() # sort the matches for deterministic order
-        return p and p[0]
+    def _loaded(self, t):
+        r"""Records the $extends of template `t` and the mtimes of its files.
+        A file changed since it was last seen is invalidated here, so that
+        `_check_changes` doesn't drop `t`, which was just loaded from it.
+
+            >>> import tempfile
+            >>> root = tempfile.mkdtemp()
+            >>> def write(text, mtime):
+            ...     path = os.path.join(root, 'page.html')
+            ...     open(path, 'w').write(text)
+            ...     os.utime(path, (mtime, mtime))
+            >>> write('Hi', 1000)
+            >>> render = Render(root, cache=True, check_interval=0)
+            >>> unicode(render.page())
+            u'Hi\n'
+            >>> write('Bye', 2000)
+            >>> [r.error for r in render.preload('page', workers=1)]
+            [None]
+            >>> t = render._cache._entries['page'][0]
+            >>> render._template('page') is t, unicode(t())
+            (True, u'Bye\n')
+        """
+        root = self._root
+        for user, used in zip([t.filename] + t.extends, t.extends):
+            self._graph.add(user, used, 'extends')
+        for filename in [t.filename] + t.extends:
+            mtime = self._root_loader.mtime(filename)
+            old = root._mtimes.get(filename, mtime)
+            root._mtimes[filename] = mtime
+            if old != mtime:
+                root.invalidate(filename)
+
+    def _check_changes(self):
+        """Invalidates what depends on the files changed since they were
+        loaded, at most once per `check_interval` seconds."""
+        root = self._root
+        now = time.time()
+        if now - root._checked_at < self._check_interval:
+            return
+        root._checked_at = now
+        for filename, mtime in root._mtimes.items():
+            new_mtime = self._root_loader.mtime(filename)
+            if new_mtime != mtime:
+                root._mtimes[filename] = new_mtime
+                root.invalidate(filename)
+
+    def invalidate(self, filename):
+        r"""Drops what depends on the file `filename`, after it changed: the
+        cached templates compiled from it, which are itself and the ones
+        extending it, and the cached fragments of all the templates whose
+        output includes it. Returns the filenames of those templates. With
+        `check_interval` this is done for the changed files automatically.
+
+            >>> loader = DictLoader({'page.html': '$def with (x)\n$cache "page":\n    $:render.nav(x)',
+            ...                      'nav.html': '$def with (x)\n<nav>$x</nav>', 'other.html': '$cache "other": $x'})
+            >>> render = Render(loader, cache=True, fragment_cache=FragmentCache(), globals={'x': 0})
+            >>> render._add_global(render, 'render')
+            >>> r = lambda: (unicode(render.page(1)).strip(), unicode(render.other()).strip())
+            >>> r()
+            (u'<nav>1</nav>', u'0')
+            >>> render._graph.uses('page.html')
+            {'nav.html': 'render'}
+            >>> loader.mapping['nav.html'] = '$def with (x)\n<p>$x</p>'
+            >>> render._keywords['globals']['x'] = 2
+            >>> render.invalidate('nav.html')
+            ['nav.html', 'page.html']
+            >>> r()
+            (u'<p>1</p>', u'0')
+        """
+        compiled = self._graph.dependents(filename, ('extends',)) | set([filename])
+        if self._root._cache is not None:
+            self._root._cache.invalidate(compiled)
+        affected = self._graph.dependents(filename, ('extends', 'render')) | set([filename])
+        fragments = self._keywords.get('fragment_cache') or fragment_cache
+        for f in affected:
+            fragments.invalidate_template(f)
+        return sorted(affected)
 
     def _template(self, name):
+        if self._check_interval is not None:
+            self._check_changes()
         if self._cache is not None:
-            if name not in self._cache:
-                self._cache[name] = self._load_template(name)
-            return self._cache[name]
+            return self._cache.get(name, self._lookup, self._load)
         else:
             return self._load_template(name)
 
+    def _stream(self, t, a, kw):
+        r"""Streams template `t` through the base layout.
+
+            >>> import tempfile
+            >>> root = tempfile.mkdtemp()
+            >>> open(os.path.join(root, 'layout.html'), 'w').write('$def with (page)\n<title>$page.title</title>\n$:page')
+            >>> open(os.path.join(root, 'page.html'), 'w').write('$var title: Hi\n$for i in range(3): <p>$i</p>')
+            >>> render = Render(root, base='layout', stream_threshold=10)
+            >>> print repr(u''.join(render.page.stream()))
+            u'<title>Hi</title>\n<p>0</p>\n<p>1</p>\n<p>2</p>\n\n'
+            >>> print repr(unicode(render.page()))
+            u'<title>Hi</title>\n<p>0</p>\n<p>1</p>\n<p>2</p>\n\n'
+        """
+        get_base = getattr(self._base, 'template', None)
+        if get_base:
+            # 页面先渲染到 spool 里 ($var 要在 layout 之前设置), 然后 layout 流式输出
+            return get_base().stream(t.spool(*a, **kw))
+        else:
+            # base 是普通的函数, 只能渲染完再分块输出
+            body = safeunicode(self._base(t(*a, **kw)))
+            n = t.stream_threshold
+            return (body[i:i + n] for i in xrange(0, len(body), n))
+
+    def preload(self, pattern='**/*', workers=None):
+        r"""Compiles the templates whose names match the glob `pattern` in
+        `workers` processes (the number of cpus by default, 1 compiles in
+        this process) and puts them in the cache, so that the first requests
+        don't pay for it. `**/` matches any number of directories.
+
+        Returns the compile time of every template, the slowest first.
+        Templates which fail to compile are reported with the error and
+        left out of the cache. Without `cache=True` the templates are only
+        checked.
+
+            >>> render = Render(DictLoader({'hello.html': '$def with (name)\nHello $name',
+            ...                             'mail/bye.txt': 'Bye', 'mail/bad.txt': '$for'}), cache=True)
+            >>> report = render.preload(workers=2)
+            >>> sorted((r.name, r.error is None) for r in report)
+            [('hello', True), ('mail/bad', False), ('mail/bye', True)]
+            >>> report[0].ms >= report[-1].ms
+            True
+            >>> 'hello' in render._cache, 'bye' in render.mail._cache
+            (True, True)
+            >>> unicode(render.hello('<b>'))
+            u'Hello &lt;b&gt;\n'
+            >>> [r.name for r in render.preload('mail/b*e', workers=1)]
+            ['mail/bye']
+        """
+        match = _name_pattern(pattern).match
+        names = [name for name in self._loader.list() if match(name)]
+        # 在创建进程之前找到文件, ChainLoader 在子进程里也知道文件是谁的
+        filenames = [self._loader.find(name) for name in names]
+        # 每个模版自己解析 $extends 的模版, 编译的顺序无所谓
+        state = (self._root_loader, self._keywords.get('extensions') or [],
+                 self._keywords.get('limits') is not None)
+
+        if workers == 1 or len(filenames) < 2:
+            results = [_preload_compile(filename, state) for filename in filenames]
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers, _preload_init, state)
+            try:
+                results = pool.map(_preload_compile, filenames)
+            finally:
+                pool.terminate()
+
+        report = []
+        for name, filename, (code, ms, error) in zip(names, filenames, results):
+            report.append(storage(name=name, filename=filename, ms=ms, error=error))
+            if code is not None and self._cache is not None:
+                self._preload_template(name, filename, marshal.loads(code))
+        report.sort(key=lambda r: r.ms, reverse=True)
+        return report
+
+    def _preload_template(self, name, filename, code):
+        # mail/hello 要放在子目录 mail 的 Render 的 cache 里
+        render = self
+        parts = name.split('/')
+        for part in parts[:-1]:
+            render = render._template(part)
+
+        def load(kind, path, name):
+            if path != filename:
+                return render._load(kind, path, name)
+            t = Template(render._loader.load(path), filename=path, loader=render._root_loader,
+                         code=code, **render._keywords)
+            render._loaded(t)
+            return t
+        render._cache.get(parts[-1], render._lookup, load)
+
+    def _render_to(self, t, fileobj, encoding, a, kw):
+        r"""Renders template `t` through the base layout into `fileobj`,
+        see Template.render_to.
+
+            >>> import StringIO
+            >>> render = Render(DictLoader({'layout.html': '$def with (page)\n<title>$page.title</title>\n$:page',
+            ...                             'page.html': '$def with (s)\n$var title: Hi\n<p>$s</p>'}), base='layout')
+            >>> f = StringIO.StringIO()
+            >>> r = render.page.render_to(f, 'utf-8', (u'\xe9',))
+            >>> f.getvalue()
+            '<title>Hi</title>\n<p>\xc3\xa9</p>\n\n'
+        """
+        get_base = getattr(self._base, 'template', None)
+        if get_base:
+            return get_base().render_to(fileobj, encoding, (t.spool(*a, **kw),))
+
+        # base 是普通的函数, 只能渲染完再写
+        r = self._base(t(*a, **kw))
+        if isinstance(fileobj, basestring):
+            f = open(fileobj, 'wb')
+            try:
+                f.write(safestr(r, encoding))
+            finally:
+                f.close()
+        else:
+            fileobj.write(safestr(r, encoding))
+        return r
+
     def __getattr__(self, name):
         t = self._template(name)
+        if isinstance(t, Template):
+            # 在模版里调用的时候记录依赖, 模版函数的 globals 里有 __template__
+            caller = sys._getframe(1)
+            if '__template__' in caller.f_globals:
+                self._graph.add(caller.f_code.co_filename, t.filename, 'render')
+            find_base = getattr(self._base, 'find', None)
+            base_filename = find_base and find_base()
+            if base_filename:
+                self._graph.add(t.filename, base_filename, 'base')
         if self._base and isinstance(t, Template):
             def template(*a, **kw):
                 return self._base(t(*a, **kw))
+            template.stream = lambda *a, **kw: self._stream(t, a, kw)
+            template.render_to = lambda fileobj, encoding='utf-8', a=(), kw={}: \
+                self._render_to(t, fileobj, encoding, a, kw)
             return template
         else:
-            return self._template(name)
+            return t
 
 render = Render
 
 def frender(path, **keywords):
-    """Creates a template from the given file path.
+    """Creates a template from the given file path. `$extends` finds the
+    templates in the same directory, unless a `loader` is given.
     """
+    keywords.setdefault('loader', DirectoryLoader(os.path.dirname(path) or '.', rescan_interval=None))
     return Template(open(path).read(), filename=path, **keywords)
 
-def compile_templates(root):
-    """Compiles templates to python code."""
-    re_start = re_compile('^', re.M)
-
+def _name_pattern(pattern):
+    """Returns the regex of a glob pattern on template names."""
+    out = []
+    for token in re.split(r'(\*\*/|\*|\?)', pattern):
+        if token == '**/':
+            out.append('(?:.*/)?')
+        elif token == '*':
+            out.append('[^/]*')
+        elif token == '?':
+            out.append('[^/]')
+        else:
+            out.append(re.escape(token))
+    return re_compile(''.join(out) + '$')
+
+# Render.preload 的子进程里用的 (loader, extensions, guard)
+_preload_state = None
+
+def _preload_init(loader, extensions, guard):
+    global _preload_state
+    _preload_state = (loader, extensions, guard)
+
+def _preload_compile(filename, state=None):
+    """Compiles template `filename`, returns (marshaled code, ms, error)."""
+    loader, extensions, guard = state or _preload_state
+    start = time.time()
+    try:
+        text = Template.normalize_text(loader.load(filename))
+        parser = Parser()
+        for ext in extensions:
+            parser = ext(parser)
+        code = Template.generate_code(text, filename, parser=parser, loader=loader)
+        code = marshal.dumps(Template.compile_code(code, filename, guard))
+        error = None
+    except Exception, e:
+        code, error = None, '%s: %s' % (e.__class__.__name__, e)
+    return code, (time.time() - start) * 1000.0, error
+
+COMPILED_HEADER = '# compiled by simutils.template: '
+
+# compile_templates 的子进程里用的 loader
+_compile_loader = None
+
+def _compile_init(root):
+    global _compile_loader
+    _compile_loader = DirectoryLoader(root, rescan_interval=None)
+
+def _compile_template_file(path, loader=None):
+    loader = loader or _compile_loader
+    text = Template.normalize_text(open(path).read())
+    code = Template.generate_code(text, path, loader=loader)
+    # 检查语法和安全性, 和运行时一样
+    Template.compile_code(code, path)
+    return path, code
+
+def _compiled_digest(filenames, dirnames, parents=()):
+    return hashlib.sha1(repr((ENGINE_VERSION, filenames, dirnames, parents))).hexdigest()
+
+def _is_compiled(init_path, digest, paths):
+    try:
+        f = open(init_path)
+        try:
+            header = f.readline().strip()
+        finally:
+            f.close()
+        mtime = os.stat(init_path).st_mtime
+        return header == COMPILED_HEADER + digest and all(os.stat(p).st_mtime <= mtime for p in paths)
+    except (IOError, OSError):
+        return False
+
+def compile_templates(root, force=False, processes=None):
+    r"""Compiles the templates under `root` to importable python packages,
+    one `__init__.py` per directory, with a template object for every file.
+
+    Directories whose `__init__.py` is newer than their templates and was
+    written for the same files and engine version are skipped, unless
+    `force` is set; a directory is also rebuilt when a template extended
+    by one of its templates changes. `$extends` names are found from
+    `root`. The templates are compiled by `processes` processes (the number
+    of cpus by default, 1 compiles in this process). Returns the list of
+    directories that were rebuilt.
+
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> os.mkdir(os.path.join(root, 'mail'))
+        >>> open(os.path.join(root, 'hello.html'), 'w').write('$def with (name)\n<b>$name</b>')
+        >>> open(os.path.join(root, 'mail', 'hello.txt'), 'w').write('$def with (name)\n<b>$name</b>')
+        >>> [os.path.relpath(d, root) for d in compile_templates(root, processes=1)]
+        ['.', 'mail']
+        >>> compile_templates(root, processes=1)
+        []
+        >>> sys.path.insert(0, os.path.dirname(root))
+        >>> package = __import__(os.path.basename(root))
+        >>> unicode(package.hello('<x>')), unicode(package.mail.hello('<x>'))
+        (u'<b>&lt;x&gt;</b>\n', u'<b><x></b>\n')
+        >>> del sys.path[0]
+
+    A changed layout rebuilds the directories of the templates extending it:
+
+        >>> open(os.path.join(root, 'layout.html'), 'w').write('<h1>\n$block body:\n    empty\n</h1>\n')
+        >>> open(os.path.join(root, 'mail', 'page.html'), 'w').write("$extends 'layout'\n$block body:\n    page\n")
+        >>> [os.path.relpath(d, root) for d in compile_templates(root, processes=1)]
+        ['.', 'mail']
+        >>> later = time.time() + 10
+        >>> os.utime(os.path.join(root, 'layout.html'), (later, later))
+        >>> [os.path.relpath(d, root) for d in compile_templates(root, processes=1)]
+        ['.', 'mail']
+    """
+    loader = DirectoryLoader(root, rescan_interval=None)
+    dirs = []
     for dirpath, dirnames, filenames in os.walk(root):
-        filenames = [f for f in filenames if not f.startswith('.') and not f.endswith('~') and not f.startswith('__init__.py')]
-
         for d in dirnames[:]:
             if d.startswith('.'):
                 dirnames.remove(d) # don't visit this dir
+        dirnames.sort()
+
+        templates = []
+        for f in sorted(filenames):
+            if f.startswith('.') or f.endswith('~') or f.startswith('__init__.py'):
+                continue
+            name = f.split('.', 1)[0]
+            if not re_compile(r'^[A-Za-z_]\w*$').match(name):
+                warnings.warn('skipping template %s, %r is not a valid python name' % (f, name))
+                continue
+            templates.append((name, os.path.join(dirpath, f)))
+
+        # $extends 的模版修改了也要重新编译
+        parents = []
+        for _, p in templates:
+            for parent, _ in find_extends(Template.normalize_text(open(p).read()), loader):
+                if parent not in parents:
+                    parents.append(parent)
+
+        init_path = os.path.join(dirpath, '__init__.py')
+        digest = _compiled_digest([os.path.basename(p) for _, p in templates], dirnames,
+                                  [os.path.relpath(p, root) for p in parents])
+        if force or not _is_compiled(init_path, digest, [p for _, p in templates] + parents):
+            dirs.append((dirpath, dirnames, templates, digest))
+
+    paths = [path for _, _, templates, _ in dirs for _, path in templates]
+    if processes == 1 or len(paths) < 2:
+        codes = dict([_compile_template_file(path, loader) for path in paths])
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _compile_init, (root,))
+        try:
+            codes = dict(pool.map(_compile_template_file, paths))
+        finally:
+            pool.terminate()
 
-        out = open(os.path.join(dirpath, '__init__.py'), 'w')
-        out.write('from web.template import CompiledTemplate, ForLoop, TemplateResult\n\n')
+    for dirpath, dirnames, templates, digest in dirs:
+        out = [COMPILED_HEADER + digest + '\n',
+               'from simutils.template import CompiledTemplate, ForLoop, TemplateResult\n\n']
         if dirnames:
-            out.write("import " + ", ".join(dirnames))
-        out.write("\n")
-
-        for f in filenames:
-            path = os.path.join(dirpath, f)
-
-            if '.' in f:
-                name, _ = f.split('.', 1)
-            else:
-                name = f
-
-            text = open(path).read()
-            text = Template.normalize_text(text)
-            code = Template.generate_code(text, path)
-
-            code = code.replace("__template__", name, 1)
-
-            out.write(code)
-
-            out.write('\n\n')
-            out.write('%s = CompiledTemplate(%s, %s)\n' % (name, name, repr(path)))
-            out.write("join_ = %s._join; escape_ = %s._escape\n\n" % (name, name))
-
-            # create template to make sure it compiles
-            t = Template(open(path).read(), path)
-        out.close()
+            out.append("import " + ", ".join(dirnames))
+        out.append("\n")
+
+        for name, path in templates:
+            out.append(codes[path].replace("__template__", name, 1))
+            out.append('\n\n')
+            out.append('%s = CompiledTemplate(%s, %s)\n\n' % (name, name, repr(path)))
+
+        # 先写到临时文件再 rename, 正在 import 的进程不会读到一半的文件
+        init_path = os.path.join(dirpath, '__init__.py')
+        tmp = '%s.%d.tmp' % (init_path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            f.write(''.join(out))
+        finally:
+            f.close()
+        os.rename(tmp, init_path)
+    return [dirpath for dirpath, _, _, _ in dirs]
 
 class ParseError(Exception):
     pass
@@ -1076,85 +3298,143 @@ class SecurityError(Exception):
     """The template seems to be trying to do something naughty."""
     pass
 
-# Enumerate all the allowed AST nodes
+class LimitExceeded(SecurityError):
+    """The render went over the RenderLimits of the template."""
+    pass
+
+# Enumerate all the allowed AST nodes (names of the classes in the ast module)
 ALLOWED_AST_NODES = [
-    "Add", "And",
-#   "AssAttr",
-    "AssList", "AssName", "AssTuple",
+    "Add", "And", "arguments",
 #   "Assert",
-    "Assign", "AugAssign",
-#   "Backquote",
-    "Bitand", "Bitor", "Bitxor", "Break",
-    "CallFunc","Class", "Compare", "Const", "Continue",
-    "Decorators", "Dict", "Discard", "Div",
-    "Ellipsis", "EmptyNode",
-#   "Exec",
-    "Expression", "FloorDiv", "For",
-#   "From",
-    "Function",
-    "GenExpr", "GenExprFor", "GenExprIf", "GenExprInner",
-    "Getattr",
+    "Assign", "Attribute", "AugAssign", "AugLoad", "AugStore",
+    "BinOp", "BitAnd", "BitOr", "BitXor", "BoolOp", "Break",
+    "Call", "ClassDef", "Compare", "comprehension", "Continue",
+    "Del", "Delete", "Dict", "Div",
+    "Ellipsis", "Eq",
+#   "ExceptHandler", "Exec",
+    "Expr", "Expression", "ExtSlice", "FloorDiv", "For", "FunctionDef",
+    "GeneratorExp",
 #   "Global",
-    "If", "IfExp",
-#   "Import",
-    "Invert", "Keyword", "Lambda", "LeftShift",
-    "List", "ListComp", "ListCompFor", "ListCompIf", "Mod",
+    "Gt", "GtE", "If", "IfExp",
+#   "Import", "ImportFrom",
+    "In", "Index", "Invert", "Is", "IsNot", "keyword", "Lambda", "List", "ListComp",
+    "Load", "LShift", "Lt", "LtE", "Mod",
     "Module",
-    "Mul", "Name", "Not", "Or", "Pass", "Power",
-#   "Print", "Printnl", "Raise",
-    "Return", "RightShift", "Slice", "Sliceobj",
-    "Stmt", "Sub", "Subscript",
+    "Mult", "Name", "Not", "NotEq", "NotIn", "Num", "Or", "Param", "Pass", "Pow",
+#   "Print", "Raise", "Repr",
+    "Return", "RShift", "Slice", "Store", "Str", "Sub", "Subscript",
 #   "TryExcept", "TryFinally",
-    "Tuple", "UnaryAdd", "UnarySub",
+    "Tuple", "UAdd", "UnaryOp", "USub",
     "While", "With", "Yield",
 ]
 
+# 有 RenderLimits 的模版检查限制用的名字, 模版里不能重新绑定
+RESERVED_NAMES = ['guard_', 'tick_', 'range', 'TemplateResult', 'extend_', 'self']
+
 class SafeVisitor(object):
-    """
+    r"""
     Make sure code is safe by walking through the AST.
 
     Code considered unsafe if:
         * it has restricted AST nodes
         * it is trying to access resricted attributes
+        * it is trying to assign to attributes
 
     Adopted from http://www.zafar.se/bkz/uploads/safe.txt (public domain, Babar K. Zafar)
+
+        >>> SafeVisitor().walk(ast.parse("x = a.b[1:2]"), 'ok.html')
+        >>> SafeVisitor().walk(ast.parse("import os\nx = a.__class__"), 'bad.html')
+        Traceback (most recent call last):
+            ...
+        SecurityError: bad.html:1 - execution of 'Import' statements is denied
+        bad.html:2 - access to attribute '__class__' is denied
+        >>> SafeVisitor().walk(ast.parse("a.b = 1"), 'bad.html')
+        Traceback (most recent call last):
+            ...
+        SecurityError: bad.html:1 - assignment to attribute 'b' is denied
+
+    With `reserved` names, which the code of templates with RenderLimits
+    uses to check the limits, the code can't bind those names, except in
+    the `self = TemplateResult(); extend_ = self.extend` of the generated
+    code:
+
+        >>> SafeVisitor(RESERVED_NAMES).walk(ast.parse("tick_ = int\nfor guard_ in x: pass"), 'bad.html')
+        Traceback (most recent call last):
+            ...
+        SecurityError: bad.html:1 - assignment to reserved name 'tick_' is denied
+        bad.html:2 - assignment to reserved name 'guard_' is denied
     """
-    def __init__(self):
-        "Initialize visitor by generating callbacks for all AST node types."
+    def __init__(self, reserved=()):
         self.errors = []
+        self.reserved = set(reserved)
 
-    def walk(self, ast, filename):
+    def walk(self, tree, filename):
         "Validate each node in AST and raise SecurityError if the code is not safe."
         self.filename = filename
-        self.visit(ast)
+        self.visit(tree)
 
         if self.errors:
             raise SecurityError, '\n'.join([str(err) for err in self.errors])
 
-    def visit(self, node, *args):
-        "Recursively validate node and all of its children."
-        def classname(obj):
-            return obj.__class__.__name__
-        nodename = classname(node)
-        fn = getattr(self, 'visit' + nodename, None)
-
-        if fn:
-            fn(node, *args)
+    def visit(self, node):
+        "Validate node and all of its children."
+        allowed = set(ALLOWED_AST_NODES)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            nodename = node.__class__.__name__
+            if nodename == 'Attribute':
+                self.visitAttribute(node)
+            elif nodename not in allowed:
+                # one error is enough for a denied statement, skip its children
+                self.fail(node)
+                continue
+            elif self.reserved:
+                if nodename == 'Assign' and self.is_prologue(node):
+                    continue
+                self.visitReserved(node)
+            children = list(ast.iter_child_nodes(node))
+            children.reverse()
+            stack.extend(children)
+
+    def visitAttribute(self, node):
+        "Disallow any attempts to access a restricted attribute or to assign an attribute."
+        if not isinstance(node.ctx, ast.Load):
+            lineno = self.get_node_lineno(node)
+            e = SecurityError("%s:%d - assignment to attribute '%s' is denied" % (self.filename, lineno, node.attr))
+            self.errors.append(e)
+        self.assert_attr(node.attr, node)
+
+    def is_prologue(self, node):
+        "Is `node` the `self = TemplateResult()` or `extend_ = self.extend` of the generated code?"
+        if len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+            return False
+        name, value = node.targets[0].id, node.value
+        if name == 'self':
+            return isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and \
+                value.func.id == 'TemplateResult' and not (value.args or value.keywords or value.starargs or value.kwargs)
+        elif name == 'extend_':
+            return isinstance(value, ast.Attribute) and value.attr == 'extend' and \
+                isinstance(value.value, ast.Name) and value.value.id == 'self'
+        return False
+
+    def visitReserved(self, node):
+        "Disallow binding the reserved names: assignments, arguments, functions and classes."
+        nodename = node.__class__.__name__
+        if nodename == 'Name' and not isinstance(node.ctx, ast.Load):
+            names = [node.id]
+        elif nodename == 'ClassDef':
+            names = [node.name]
+        elif nodename in ('FunctionDef', 'Lambda'):
+            # *args 和 **kwargs 的名字是字符串, 不是 Name
+            names = [getattr(node, 'name', None), node.args.vararg, node.args.kwarg]
         else:
-            if nodename not in ALLOWED_AST_NODES:
-                self.fail(node, *args)
-
-        for child in node.getChildNodes():
-            self.visit(child, *args)
-
-    def visitName(self, node, *args):
-        "Disallow any attempts to access a restricted attr."
-        #self.assert_attr(node.getChildren()[0], node)
-        pass
-
-    def visitGetattr(self, node, *args):
-        "Disallow any attempts to access a restricted attribute."
-        self.assert_attr(node.attrname, node)
+            return
+        for name in names:
+            if name in self.reserved:
+                lineno = self.get_node_lineno(node)
+                e = SecurityError("%s:%d - assignment to reserved name '%s' is denied" % (self.filename, lineno, name))
+                self.errors.append(e)
 
     def assert_attr(self, attrname, node):
         if self.is_unallowed_attr(attrname):
@@ -1168,15 +3448,44 @@ class SafeVisitor(object):
             or name.startswith('im_')
 
     def get_node_lineno(self, node):
-        return (node.lineno) and node.lineno or 0
+        return getattr(node, 'lineno', None) or 0
 
-    def fail(self, node, *args):
+    def fail(self, node):
         "Default callback for unallowed AST nodes."
         lineno = self.get_node_lineno(node)
         nodename = node.__class__.__name__
         e = SecurityError("%s:%d - execution of '%s' statements is denied" % (self.filename, lineno, nodename))
         self.errors.append(e)
 
+class LoopGuard(ast.NodeTransformer):
+    r"""Instruments the loops of the template code for RenderLimits: the
+    iterables of for loops and comprehensions are wrapped in `guard_` and
+    while loops call `tick_` first. The line numbers are kept.
+
+        >>> tree = LoopGuard().visit(ast.parse("for i in x:\n    while i: i -= 1"))
+        >>> ast.dump(tree.body[0].iter)
+        "Call(func=Name(id='guard_', ctx=Load()), args=[Name(id='x', ctx=Load())], keywords=[], starargs=None, kwargs=None)"
+        >>> ast.dump(tree.body[0].body[0].body[0])
+        "Expr(value=Call(func=Name(id='tick_', ctx=Load()), args=[], keywords=[], starargs=None, kwargs=None))"
+    """
+    def _call(self, name, args, node):
+        return ast.copy_location(ast.Call(ast.Name(name, ast.Load()), args, [], None, None), node)
+
+    def visit_For(self, node):
+        self.generic_visit(node)
+        node.iter = self._call('guard_', [node.iter], node.iter)
+        return node
+
+    def visit_comprehension(self, node):
+        self.generic_visit(node)
+        node.iter = self._call('guard_', [node.iter], node.iter)
+        return node
+
+    def visit_While(self, node):
+        self.generic_visit(node)
+        node.body.insert(0, ast.copy_location(ast.Expr(self._call('tick_', [], node)), node))
+        return node
+
 class TemplateResult(object, DictMixin):
     """Dictionary like object for storing template output.
 
@@ -1209,17 +3518,114 @@ class TemplateResult(object, DictMixin):
 
         self.__dict__['_parts'] = []
         self.__dict__["extend"] = self._parts.extend
+        self.__dict__['_spool'] = None
+        # 大于 0 的时候不要 flush 流式输出, 见 FragmentCache.fragment
+        self.__dict__['_hold'] = 0
 
         self._d.setdefault("__body__", None)
 
     def keys(self):
         return self._d.keys()
 
+    def _stream_to(self, write, threshold):
+        """Sends the output to `write` in chunks of about `threshold`
+        characters instead of keeping it. Call `_flush` at the end.
+        """
+        parts = self._parts
+        parts_extend = parts.extend
+        size = [0]
+
+        def flush():
+            if not parts:
+                return
+            items = parts[:]
+            parts[:] = []
+            size[0] = 0
+            try:
+                write(u"".join(items))
+            except TypeError:
+                # layout 里的页面, 从 spool 里分块输出, 不合并到一个字符串里
+                text = []
+                for item in items:
+                    if item.__class__ is TemplateResult:
+                        if text:
+                            write(u"".join(text))
+                            text = []
+                        for chunk in item._chunks(threshold):
+                            write(chunk)
+                    else:
+                        text.append(item)
+                if text:
+                    write(u"".join(text))
+
+        d = self.__dict__
+
+        def extend(items):
+            # 用内置的 extend 和 map, 每个片段不需要单独处理
+            parts_extend(items)
+            size[0] += sum(map(len, items))
+            if size[0] >= threshold and not d['_hold']:
+                flush()
+
+        self.__dict__['extend'] = extend
+        self.__dict__['_flush'] = flush
+
+    def _chunks(self, size):
+        """Yields the output in chunks, reading it from the spool if any."""
+        spool = self._spool
+        if spool is not None:
+            self.__dict__['_spool'] = None
+            spool.seek(0)
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            while True:
+                data = spool.read(size)
+                chunk = decoder.decode(data, not data)
+                if chunk:
+                    yield chunk
+                if not data:
+                    break
+            spool.close()
+        self._prepare_body()
+        body = self._d['__body__']
+        if body:
+            yield body
+
+    def _write_to(self, write, encoding, batch=1024):
+        """Encodes the output and passes it to `write`, joining `batch`
+        parts at a time. The output is consumed."""
+        if self._spool is not None:
+            for chunk in self._chunks(8192):
+                write(chunk.encode(encoding))
+            return
+        body = self._d['__body__']
+        if body:
+            self._d['__body__'] = u''
+            write(body.encode(encoding))
+        parts = self._parts
+        for i in xrange(0, len(parts), batch):
+            items = parts[i:i + batch]
+            try:
+                write(u"".join(items).encode(encoding))
+            except TypeError:
+                # layout 里的页面 (TemplateResult), 从 spool 里分块输出
+                for item in items:
+                    if item.__class__ is TemplateResult:
+                        item._write_to(write, encoding, batch)
+                    else:
+                        write(safeunicode(item).encode(encoding))
+        parts[:] = []
+
     def _prepare_body(self):
         """Prepare value of __body__ by joining parts.
         """
+        if self._spool is not None:
+            self._parts[:0] = list(self._chunks(8192))
         if self._parts:
-            value = u"".join(self._parts)
+            try:
+                value = u"".join(self._parts)
+            except TypeError:
+                # 有未展开的页面 (TemplateResult)
+                value = u"".join([safeunicode(p) for p in self._parts])
             self._parts[:] = []
             body = self._d.get('__body__')
             if body:
@@ -1474,10 +3880,24 @@ def test():
     """
     pass
 
+USAGE = """
+Usage:
+    template.py --compile <root> [--force] [--processes=<n>]
+    template.py
+
+Options:
+    --compile        Compile the templates under <root> to python packages.
+    --force          Recompile the directories which are up to date too.
+    --processes=<n>  Number of compiling processes, defaults to the number of cpus.
+"""
+
 if __name__ == "__main__":
-    import sys
-    if '--compile' in sys.argv:
-        compile_templates(sys.argv[2])
+    from simutils.thirdparty import docopt
+    args = docopt(USAGE)
+    if args['--compile']:
+        processes = args['--processes'] and int(args['--processes']) or None
+        for d in compile_templates(args['<root>'], force=args['--force'], processes=processes):
+            print 'compiled', d
     else:
         import doctest
         doctest.testmod()
@@ -6,6 +6,7 @@ __author__ = 'wujiabin'
 
 import collections
 import itertools
+import json
 import threading
 import urllib
 
@@ -169,12 +170,22 @@ def htmlquote(text):
 
         >>> htmlquote(u"<'&\">")
         u'&lt;&#39;&amp;&quot;&gt;'
+        >>> htmlquote(u'plain text')
+        u'plain text'
     """
-    text = text.replace(u"&", u"&amp;")  # Must be done first!
-    text = text.replace(u"<", u"&lt;")
-    text = text.replace(u">", u"&gt;")
-    text = text.replace(u"'", u"&#39;")
-    text = text.replace(u'"', u"&quot;")
+    # 短字符串先用 in 检查, 只对出现的字符做 replace, 没有特殊字符的直接返回;
+    # 长字符串上 in 比没有匹配的 replace 还慢, 直接 replace
+    check = len(text) < 256
+    if not check or u"&" in text:
+        text = text.replace(u"&", u"&amp;")  # Must be done first!
+    if not check or u"<" in text:
+        text = text.replace(u"<", u"&lt;")
+    if not check or u">" in text:
+        text = text.replace(u">", u"&gt;")
+    if not check or u"'" in text:
+        text = text.replace(u"'", u"&#39;")
+    if not check or u'"' in text:
+        text = text.replace(u'"', u"&quot;")
     return text
 
 
@@ -184,12 +195,38 @@ def htmlunquote(text):
 
         >>> htmlunquote(u'&lt;&#39;&amp;&quot;&gt;')
         u'<\'&">'
+        >>> htmlunquote(u'&amp;lt;')
+        u'&lt;'
     """
-    text = text.replace(u"&quot;", u'"')
-    text = text.replace(u"&#39;", u"'")
-    text = text.replace(u"&gt;", u">")
-    text = text.replace(u"&lt;", u"<")
-    text = text.replace(u"&amp;", u"&")  # Must be done last!
+    # 所有的实体都以 & 开头
+    if u"&" not in text:
+        return text
+    if u"&quot;" in text:
+        text = text.replace(u"&quot;", u'"')
+    if u"&#39;" in text:
+        text = text.replace(u"&#39;", u"'")
+    if u"&gt;" in text:
+        text = text.replace(u"&gt;", u">")
+    if u"&lt;" in text:
+        text = text.replace(u"&lt;", u"<")
+    if u"&amp;" in text:
+        text = text.replace(u"&amp;", u"&")  # Must be done last!
+    return text
+
+
+def jsquote(text):
+    r"""
+    Encodes `text` for use inside a javascript or JSON string literal, also
+    when it's in a <script> element of a HTML page.
+
+        >>> jsquote(u'"a"</script>\n')
+        u'\\"a\\"\\u003c/script\\u003e\\n'
+    """
+    text = json.dumps(text)[1:-1].decode('ascii')
+    # 在 html 里有特殊含义的字符也转义, 避免提前结束 <script>
+    for c, escaped in ((u"<", u"\\u003c"), (u">", u"\\u003e"), (u"&", u"\\u0026"), (u"'", u"\\u0027")):
+        if c in text:
+            text = text.replace(c, escaped)
     return text
 
 
@@ -205,11 +242,13 @@ def websafe(val):
         >>> websafe('\xe2\x80\xbd')
         u'\u203d'
     """
-    if val is None:
+    if isinstance(val, unicode):
+        pass
+    elif val is None:
         return u''
     elif isinstance(val, str):
         val = val.decode('utf-8')
-    elif not isinstance(val, unicode):
+    else:
         val = unicode(val)
 
     return htmlquote(val)
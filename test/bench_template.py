@@ -0,0 +1,148 @@
+#!/bin/env python
+# ^_^ encoding: utf-8 ^_^
+# @date: 2026/10/19
+"""
+bench_template
+模版的性能测试, 运行: python bench_template.py [parse] [render] [write] [many]
+"""
+
+__author__ = 'wujiabin'
+
+import os
+import sys
+import tempfile
+
+from simutils import template
+from simutils.decorators import Timer
+
+CHUNK = """<div class="row">
+    <h2>$title</h2>
+$for item in items:
+    <li class="$loop.parity">$item.name: $:item.value</li>
+$if user:
+    Hello, $user.name! $(len(items)) items.
+$else:
+    Hello, guest.
+</div>
+"""
+
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024]
+
+
+def make_template(size):
+    """Template text of about `size` bytes."""
+    head = "$def with (title, items, user)\n"
+    return head + CHUNK * (size / len(CHUNK) + 1)
+
+
+def best_of(n, f, *args):
+    best = None
+    for _ in xrange(n):
+        with Timer() as t:
+            f(*args)
+        if best is None or t.elapsed_ms < best:
+            best = t.elapsed_ms
+    return best
+
+
+def bench_parse():
+    print 'parse time'
+    print '%10s %12s %12s' % ('size', 'ms', 'ms/KB')
+    for size in SIZES:
+        text = make_template(size)
+        ms = best_of(3, template.Parser().parse, text)
+        print '%10d %12.3f %12.4f' % (len(text), ms, ms / (len(text) / 1024.0))
+
+
+class Item(object):
+    def __init__(self, i):
+        self.name = u'item <%d>' % i
+        self.value = i
+
+
+RENDER_CASES = [
+    # name, template, args
+    ('static', "$def with ()\n" + "<p>some static text in a paragraph</p>\n" * 200, ()),
+    ('escape', "$def with (s, n)\n" + "<p>$s $n $:s</p>\n" * 200, (u'Tom & Jerry', 42)),
+    ('loop', "$def with (items)\n$for item in items:\n    <li>$item.name: $item.value</li>\n",
+     ([Item(i) for i in xrange(1000)],)),
+    ('loop_index', "$def with (items)\n$for item in items:\n    <li class=\"$loop.parity\">$loop.index $item.name</li>\n",
+     ([Item(i) for i in xrange(1000)],)),
+    ('chunk', make_template(10 * 1024), (u'Title', [Item(i) for i in xrange(10)], None)),
+]
+
+
+def bench_render():
+    print 'render time'
+    print '%12s %12s %12s' % ('case', 'ms', 'KB')
+    for name, text, args in RENDER_CASES:
+        t = template.Template(text, filename='bench.html')
+        out = unicode(t(*args))
+        ms = best_of(20, lambda: unicode(t(*args)))
+        print '%12s %12.3f %12.1f' % (name, ms, len(out) / 1024.0)
+
+
+def write_str(t, path, args):
+    f = open(path, 'wb')
+    try:
+        f.write(str(t(*args)))
+    finally:
+        f.close()
+
+
+def bench_write():
+    print 'write to file time'
+    print '%10s %12s %12s' % ('KB', 'str+write', 'render_to')
+    path = os.path.join(tempfile.mkdtemp(), 'out.html')
+    items = [Item(i) for i in xrange(10)]
+    for size in SIZES:
+        t = template.Template(make_template(size), filename='bench.html')
+        args = (u'T\xedtulo', items, None)
+        ms_str = best_of(3, write_str, t, path, args)
+        ms_to = best_of(3, t.render_to, path, 'utf-8', args)
+        print '%10d %12.3f %12.3f' % (os.path.getsize(path) / 1024, ms_str, ms_to)
+    os.remove(path)
+
+
+MANY_TEMPLATE = """$def with (user, items)
+<p>Hello $user.name,</p>
+<ul>
+$for item in items:
+    <li>$item.name: $item.value</li>
+</ul>
+"""
+
+
+def bench_many():
+    print 'render_many throughput'
+    print '%16s %12s' % ('mode', 'renders/s')
+    t = template.Template(MANY_TEMPLATE, filename='bench.html')
+    items = [Item(i) for i in xrange(20)]
+    contexts = [dict(user=Item(i), items=items) for i in xrange(20000)]
+
+    def calls():
+        for kw in contexts:
+            unicode(t(**kw))
+
+    def many(**kw):
+        for _ in t.render_many(contexts, **kw):
+            pass
+
+    cases = [('call', calls, {}), ('render_many', many, {}),
+             ('threads=4', many, dict(workers=4)), ('processes=4', many, dict(workers=4, processes=True))]
+    for name, f, kw in cases:
+        ms = best_of(3, lambda: f(**kw))
+        print '%16s %12d' % (name, len(contexts) / (ms / 1000.0))
+
+
+BENCHES = {
+    'parse': bench_parse,
+    'render': bench_render,
+    'write': bench_write,
+    'many': bench_many,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHES)
+    for name in names:
+        BENCHES[name]()
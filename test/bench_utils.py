@@ -0,0 +1,69 @@
+#!/bin/env python
+# ^_^ encoding: utf-8 ^_^
+# @date: 2026/10/19
+"""
+bench_utils
+utils 的性能测试, 运行: python bench_utils.py [escape]
+"""
+
+__author__ = 'wujiabin'
+
+import sys
+
+from simutils import utils
+from simutils.decorators import Timer
+
+ESCAPE_CASES = [
+    ('short', u'hello world'),
+    ('short_special', u'Tom & Jerry'),
+    ('medium', u'lorem ipsum dolor sit amet ' * 10),
+    ('medium_special', u'<a href="x">y</a> & ' * 10),
+    ('long', u'lorem ipsum dolor sit amet ' * 2000),
+    ('long_special', u'<a href="x">y</a> & ' * 2000),
+]
+
+
+def htmlquote_replace(text):
+    """原来的实现, 作为对比"""
+    text = text.replace(u"&", u"&amp;")
+    text = text.replace(u"<", u"&lt;")
+    text = text.replace(u">", u"&gt;")
+    text = text.replace(u"'", u"&#39;")
+    text = text.replace(u'"', u"&quot;")
+    return text
+
+
+def best_of(n, f, *args):
+    best = None
+    for _ in xrange(n):
+        with Timer() as t:
+            f(*args)
+        if best is None or t.elapsed_ms < best:
+            best = t.elapsed_ms
+    return best
+
+
+def loop(f, s, number):
+    for _ in xrange(number):
+        f(s)
+
+
+def bench_escape():
+    print 'escape time (us per call)'
+    print '%16s %10s %12s %12s %12s' % ('case', 'len', 'replace', 'htmlquote', 'htmlunquote')
+    for name, s in ESCAPE_CASES:
+        number = max(10, 200000 / len(s))
+        quoted = utils.htmlquote(s)
+        times = [best_of(3, loop, f, arg, number) * 1000.0 / number
+                 for f, arg in [(htmlquote_replace, s), (utils.htmlquote, s), (utils.htmlunquote, quoted)]]
+        print '%16s %10d %12.3f %12.3f %12.3f' % tuple([name, len(s)] + times)
+
+
+BENCHES = {
+    'escape': bench_escape,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHES)
+    for name in names:
+        BENCHES[name]()
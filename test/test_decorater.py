@@ -17,3 +17,42 @@ print f(2)
 print f(3)
 print f(4)
 print f(1)
+
+# 很多短命的线程用同一个 Profiler, 结束的线程的统计会被合并, 不会一直增长
+import threading
+from simutils.decorators import Profiler
+
+p = Profiler()
+
+
+def request():
+    with p.span('request'):
+        pass
+
+for _ in xrange(200):
+    t = threading.Thread(target=request)
+    t.start()
+    t.join()
+request()
+assert len(p._thread_stats) <= 2, len(p._thread_stats)
+assert p.stats()['request']['count'] == 201
+print 'profiler threads:', len(p._thread_stats)
+
+# 抛异常的调用不会留下这个 key 的锁
+from simutils.decorators.func_decorators import invoked_once_per_key
+
+
+@invoked_once_per_key
+def fail(x):
+    raise ValueError(x)
+
+for i in xrange(10):
+    try:
+        fail(i)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('fail(%d) did not raise' % i)
+closure = dict(zip(fail.func_code.co_freevars, [c.cell_contents for c in fail.func_closure]))
+assert closure['key_locks'] == {}, closure['key_locks']
+print 'key locks:', len(closure['key_locks'])